@@ -0,0 +1,217 @@
+import time
+from collections import OrderedDict
+
+from channels.auth import AuthMiddleware
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import (
+    BACKEND_SESSION_KEY,
+    HASH_SESSION_KEY,
+    SESSION_KEY,
+    get_user_model,
+    load_backend,
+)
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.utils.crypto import constant_time_compare
+
+
+# The same checks as channels' get_user, but the user comes with
+# its Player row in one joined query, so consumers never have to
+# go back to the database for the player's name
+@database_sync_to_async
+def get_user(scope):
+    session = scope["session"]
+
+    try:
+        user_id = get_user_model()._meta.pk.to_python(session[SESSION_KEY])
+        backend_path = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return AnonymousUser()
+
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return AnonymousUser()
+
+    backend = load_backend(backend_path)
+    user = (
+        get_user_model()
+        ._default_manager.select_related("player")
+        .filter(pk=user_id)
+        .first()
+    )
+
+    if user is None or not getattr(backend, "user_can_authenticate", bool)(user):
+        return AnonymousUser()
+
+    # Verify the session
+    session_hash = session.get(HASH_SESSION_KEY)
+    if not (
+        session_hash
+        and constant_time_compare(session_hash, user.get_session_auth_hash())
+    ):
+        session.flush()
+        return AnonymousUser()
+
+    return user
+
+
+# A bounded map whose entries expire ttl seconds after they were stored.
+# Once it is full the least recently used entry makes room.
+class TTLCache:
+    def __init__(self, max_size=10000, ttl=60, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        item = self.items.get(key)
+
+        if item is None:
+            return None
+
+        expires, value = item
+
+        if expires <= self.clock():
+            del self.items[key]
+            return None
+
+        self.items.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return None
+
+        self.items[key] = (self.clock() + self.ttl, value)
+        self.items.move_to_end(key)
+
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def discard(self, key):
+        self.items.pop(key, None)
+
+    def discard_where(self, test):
+        for key in [key for key, (expires, value) in self.items.items() if test(value)]:
+            del self.items[key]
+
+
+# Signed-in users by session key. Every process keeps its own copy,
+# settings.PLAYER_AUTH_SHARED_CACHE can name a Django cache that they
+# share as well. Entries carry the user's version, which is bumped when
+# their password changes, and a local hit is checked against the shared
+# cache, so one stale process can't hand out a session that was signed
+# out everywhere else.
+sessions = TTLCache(settings.PLAYER_AUTH_CACHE_SIZE, settings.PLAYER_AUTH_CACHE_TTL)
+
+
+def shared_cache():
+    if settings.PLAYER_AUTH_SHARED_CACHE is None:
+        return None
+
+    return caches[settings.PLAYER_AUTH_SHARED_CACHE]
+
+
+def session_cache_key(session_key):
+    return "palace.auth.session.%s" % session_key
+
+
+def user_cache_key(user_id):
+    return "palace.auth.user.%s" % user_id
+
+
+async def cached_user(session_key):
+    entry = sessions.get(session_key)
+    shared = shared_cache()
+
+    if shared is None:
+        return None if entry is None else entry[0]
+
+    # Held here already, still signed in and on the same version in
+    # the shared cache costs one round trip
+    if entry is not None:
+        user, version = entry
+        keys = [session_cache_key(session_key), user_cache_key(user.pk)]
+        found = await shared.aget_many(keys)
+
+        if keys[0] in found and found.get(keys[1]) == version:
+            return user
+
+        sessions.discard(session_key)
+        return None
+
+    entry = await shared.aget(session_cache_key(session_key))
+
+    if entry is None:
+        return None
+
+    user, version = entry
+
+    if await shared.aget(user_cache_key(user.pk)) != version:
+        await shared.adelete(session_cache_key(session_key))
+        return None
+
+    sessions.set(session_key, entry)
+    return user
+
+
+async def remember(session_key, user):
+    shared = shared_cache()
+    version = None
+
+    if shared is not None:
+        version = await shared.aget(user_cache_key(user.pk))
+        await shared.aset(
+            session_cache_key(session_key), (user, version), settings.PLAYER_AUTH_CACHE_TTL
+        )
+
+    sessions.set(session_key, (user, version))
+
+
+# Called on logout
+def forget_session(session_key):
+    sessions.discard(session_key)
+    shared = shared_cache()
+
+    if shared is not None:
+        shared.delete(session_cache_key(session_key))
+
+
+# Called when a user's password changes, all their sessions are dropped
+def forget_user(user_id):
+    sessions.discard_where(lambda entry: entry[0].pk == user_id)
+    shared = shared_cache()
+
+    if shared is not None:
+        shared.set(user_cache_key(user_id), time.time_ns(), None)
+
+
+# Handshakes look the session up in the cache first, only a miss
+# touches the session table and the user. Sockets without a session
+# cookie are anonymous straight away.
+class PlayerAuthMiddleware(AuthMiddleware):
+    async def resolve_scope(self, scope):
+        session_key = scope["session"].session_key
+
+        if session_key is None:
+            scope["user"]._wrapped = AnonymousUser()
+            return None
+
+        user = await cached_user(session_key)
+
+        if user is None:
+            user = await get_user(scope)
+
+            if user.is_authenticated:
+                await remember(session_key, user)
+
+        scope["user"]._wrapped = user
+
+
+def PlayerAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(PlayerAuthMiddleware(inner)))
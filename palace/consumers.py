@@ -1,17 +1,23 @@
 import json
-import random
-
-from channels.generic.websocket import AsyncWebsocketConsumer, SyncConsumer
+import logging
 import time
-from asgiref.sync import async_to_sync
+
+from channels.consumer import AsyncConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.auth import login
 from channels.db import database_sync_to_async
 from django.conf import settings
-from . import models
+from . import models, protocol
+from .game import Game, GameRegistry, Player
+from .history import history
+from .persistence import PlayerWriteQueue, record_chat, record_status, record_vote
+from .ratelimit import limits
+from .sharding import moderator_for
+from .snapshots import SnapshotStore
+from .timers import Scheduler
 from channels.layers import get_channel_layer
-import random
-from time import sleep
-from threading import Timer
+
+logger = logging.getLogger(__name__)
 
 
 # WebSocket 'consumers' consume front end WebSockets
@@ -21,17 +27,39 @@ class LobbyConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.lobby_name = self.scope["url_route"]["kwargs"]["lobby_name"]
         self.room_group_name = "palace_%s" % self.lobby_name
-        self.scope["session"]["seed"] = random.randint(1, 1000)
+        self.moderator = moderator_for(self.lobby_name)
         self.user = self.scope["user"]
-        self.username = await self.get_username()
+        # The auth middleware loaded the player along with the user
+        self.username = self.user.player.player
+
+        # Clients that ask for the binary protocol get it, JSON otherwise
+        subprotocols = self.scope.get("subprotocols", [])
+        self.binary = protocol.BINARY in subprotocols
+
+        # What this socket may still send, and what it was last told it couldn't
+        self.buckets = limits.connection()
+        self.throttled = set()
+
+        if self.binary:
+            subprotocol = protocol.BINARY
+        elif protocol.JSON in subprotocols:
+            subprotocol = protocol.JSON
+        else:
+            subprotocol = None
 
         # Join room group
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
+        await self.accept(subprotocol)
+
+        # Whatever was said before the page was (re)loaded
+        lines, before = await database_sync_to_async(history.recent)(self.lobby_name)
+
+        if lines:
+            await self.send_frames([protocol.history(lines, before)])
 
         # Game worker reacts to new connection
         await self.channel_layer.send(
-            "moderator",
+            self.moderator,
             {
                 "type": "connect",
                 "username": self.username,
@@ -44,9 +72,10 @@ class LobbyConsumer(AsyncWebsocketConsumer):
     # by page being closed or connectivity issue
     async def disconnect(self, close_code):
         await self.channel_layer.send(
-            "moderator",
+            self.moderator,
             {
                 "type": "disconnect",
+                "id": self.lobby_name,
                 "username": self.username,
                 "player_channel": self.channel_name,
             },
@@ -70,284 +99,314 @@ class LobbyConsumer(AsyncWebsocketConsumer):
     async def receive(self, text_data):
         text_data_json = json.loads(text_data)
         message = text_data_json["message"]
-        username = self.scope["user"].username
+        username = self.username
 
-        if message[1:2] == ">":
+        # Too much too fast is turned away before it costs anyone else
+        # anything. The client hears about it once, not for every line.
+        kind = "command" if message[1:2] == ">" else "chat"
+        wait = limits.take(self.buckets, username, kind)
+
+        if wait:
+            if kind not in self.throttled:
+                self.throttled.add(kind)
+                await self.send_frames([protocol.error("rate_limited", int(wait * 1000) + 1)])
+            return None
+
+        self.throttled.discard(kind)
+
+        # Older lines of the log, before the cursor the client was given
+        if message[:2] == "h>":
+            lines, before = await database_sync_to_async(history.before)(
+                self.lobby_name, message[2:]
+            )
+            await self.send_frames([protocol.history(lines, before)])
+        elif message[1:2] == ">":
             await self.channel_layer.send(
-                "moderator",
+                self.moderator,
                 {
                     "type": "demand",
+                    "id": self.lobby_name,
                     "demand": message[:1],
                     "message": message[2:],
                     "username": username,
+                    "player_channel": self.channel_name,
                 },
             )
         else:
             await self.channel_layer.group_send(
                 self.room_group_name,
-                {
-                    "type": "chat_message",
-                    "message": message,
-                    "username": username,
-                },
+                protocol.frame_message([protocol.chat(message, username)]),
             )
+            record_chat(self.lobby_name, username, message)
 
-    # Channel Layer function, [sends] by the "update" function
-    async def refresh_lobby(self, event):
-        player_list = await self.get_players()
-        message = ", ".join(player_list)
-
-        # Send player list to WebSocket in HTML element
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "game_event",
-                "event": "users",
-            },
-        )
-
-    # Make a string player_list by query to Game objects
-    @database_sync_to_async
-    def get_players(self):
-        lobby = models.Game.objects.get(lobby_name=self.lobby_name)
-        player_list = []
-
-        # Players have a foreign key of a joined lobby
-        for player in lobby.players.order_by("player"):
-            player_list.append(player.player)
-
-        return player_list
-
-    @database_sync_to_async
-    def get_username(self):
-        return self.user.player.player
-
-    # Make an integer player_count by query to Game objects
-    @database_sync_to_async
-    def get_player_count(self):
-        lobby = models.Game.objects.get(lobby_name=self.lobby_name)
-        self.user.player.save()
-        player_count = 0
-
-        # Players have a foreign key of a joined lobby
-        for player in lobby.players.order_by("player"):
-            player_count += 1
-
-        return player_count
+    # Everything for the client arrives as a "frame" message encoded
+    # once by the sender, it goes out unchanged in this socket's protocol
+    async def frame(self, event):
+        if self.binary:
+            await self.send(bytes_data=event["bytes"])
+        else:
+            await self.send(text_data=event["text"])
 
-    # Below are 4 kinds of messages that can be sent to the client
-    # First is the chat_message from other players
-    # Then game_message, a broadcast from the game
-    # Then game_event, which tells the client to run a function
-    # Lastly game_event, which reveals something to one client
+    # Frames only this socket gets are encoded here
+    async def send_frames(self, frames):
+        if self.binary:
+            await self.send(bytes_data=protocol.encode_binary(frames))
+        else:
+            await self.send(text_data=protocol.encode(frames))
 
-    async def chat_message(self, event):
-        message = event["message"]
-        username = event["username"]
+    # The channel layer gave up on this socket for falling too far
+    # behind, the page reloads and starts over
+    async def layer_overflow(self, event):
+        await self.close(code=4008)
 
-        # Send message to WebSocket
-        await self.send(
-            text_data=json.dumps(
-                {"type": "chat", "message": message, "username": username}
-            )
+    async def assigned_roles(self, event):
+        await self.channel_layer.send(
+            self.moderator,
+            {
+                "type": "init.game",
+                "id": self.lobby_name,
+                "player": self.username,
+                "player_channel": self.channel_name,
+            },
         )
 
-    async def game_message(self, event):
-        message = event["message"]
-        theme = event["theme"]
-
-        message.replace(
-            self.scope["user"].username, f"{self.scope['user'].username}(you)"
-        )
 
-        await self.send(
-            text_data=json.dumps(
-                {"type": "broadcast", "message": message, "theme": theme}
+# This 'worker' runs on a redis server and acts as an
+# invisible spectator. Its purpose is to keep track of
+# 'game-state', that is, what each player's role is,
+# and the actions they are performing. If not for this,
+# the players would not be able to keep secrets.
+# One moderator runs every lobby's game, each one is kept
+# apart in the registry under its lobby name. Waits between
+# game phases go through the scheduler instead of sleeping,
+# so the moderator is always free to handle the next event.
+# Games are saved as they change, a restarted moderator
+# resumes them before it handles anything else. Its database
+# writes are queued and batched, a slow database never holds
+# up the games.
+class GameConsumer(AsyncConsumer):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.games = GameRegistry()
+        self.scheduler = Scheduler()
+        self.snapshots = None
+        self.snapshot_flush = None
+        self.resumed = False
+        self.outbox = {}
+        self.player_writes = PlayerWriteQueue(max_delay=0.25)
+
+    async def dispatch(self, message):
+        if not self.resumed:
+            await self.resume_games()
+
+        # One lobby's broken event is logged and dropped, it mustn't take
+        # the moderator, and every other lobby's game, down with it
+        try:
+            await super().dispatch(message)
+        except Exception:
+            logger.exception(
+                "Moderator failed to handle %s for %s", message["type"], message.get("id")
             )
-        )
 
-    async def game_event(self, event):
-        game_event = event["event"]
+        await self.flush_outbox()
 
-        if "message" in event:
-            message = event["message"]
-        else:
-            message = ""
-
-        if "theme" in event:
-            theme = event["theme"]
-        else:
-            theme = ""
-
-        if "player" in event:
-            player = event["player"]
-        else:
-            player = ""
+        if "id" in message:
+            self.save(message["id"])
 
-        if "role" in event:
-            role = event["role"]
-        else:
-            role = ""
+    # Sent by runmoderator when a worker starts, so games resume
+    # without waiting for a player to do something
+    async def restore(self, event):
+        pass
 
-        message.replace(
-            self.scope["user"].username, f"{self.scope['user'].username}(you)"
-        )
+    async def resume_games(self):
+        self.resumed = True
 
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "event",
-                    "event": game_event,
-                    "message": message,
-                    "theme": theme,
-                    "player": player,
-                    "role": role,
-                }
+        if settings.MODERATOR_SNAPSHOTS:
+            self.snapshots = SnapshotStore(
+                settings.MODERATOR_SNAPSHOTS, self.scope["channel"]
             )
-        )
 
-    async def assigned_roles(self, event):
-        profile = await self.get_username()
-        player_channel = self.channel_name
+            for lobby_name, state in self.snapshots.load().items():
+                game = Game.from_state(lobby_name, state)
+                self.games.add(game)
 
-        await self.channel_layer.send(
-            "moderator",
-            {"type": "init.game", "player": profile, "player_channel": player_channel},
-        )
+                for phase, due in state["timers"]:
+                    timer = self.later(game, max(0, due - time.time()), getattr(self, phase))
 
+                    if phase in ("begin", "assign_roles"):
+                        game.countdown = timer
 
-class Player:
-    out = False
-    connected = True
-    spectator = False
-    role = ""
-    channel = ""
-    votes = 0
+        await self.clear_orphans(self.scope["channel"], set(self.games.games))
 
-    def __init__(self, channel):
-        self.channel = channel
+    # Lobbies this shard owns but has no game for were left behind by
+    # a worker that stopped, let their players join other games
+    @database_sync_to_async
+    def clear_orphans(self, shard, running):
+        orphans = [
+            lobby_name
+            for lobby_name in models.Game.objects.values_list("lobby_name", flat=True)
+            if lobby_name not in running and moderator_for(lobby_name) == shard
+        ]
+
+        models.Player.objects.filter(ingame__lobby_name__in=orphans).update(ingame=None)
+        models.Game.objects.filter(lobby_name__in=orphans).delete()
+        models.lobbies_changed()
+
+    # Queue the game's latest state to be written, a closed game is dropped
+    def save(self, lobby_name):
+        if self.snapshots is None:
+            return None
 
+        game = self.games.get(lobby_name)
+        self.snapshots.track(lobby_name, game.to_state() if game else None)
 
-class Game:
-    players = {}
-    roles = ["King", "Guard", "Guard", "Guard", "Guard", "Beast"]
-    lobby = True
-    game_over = False
-    capacity = 6
-    player_count = 0
-    votes = 0
-    group = ""
+        if self.snapshots.pending and self.snapshot_flush is None:
+            self.snapshot_flush = self.scheduler.call_later(0.25, self.flush_snapshots)
 
-    def __init__(self, lobby_name):
-        self.group = "palace_%s" % lobby_name
-        random.shuffle(self.roles)
+    # Written on a thread while the games go on. One batch is written
+    # at a time, so they land in order, what was saved meanwhile goes
+    # in the next one.
+    async def flush_snapshots(self):
+        try:
+            await database_sync_to_async(self.snapshots.write, thread_sensitive=False)(
+                self.snapshots.take()
+            )
+        finally:
+            self.snapshot_flush = None
 
+        if self.snapshots.pending:
+            self.snapshot_flush = self.scheduler.call_later(0.25, self.flush_snapshots)
 
-# This 'worker' runs on a redis server and acts as an
-# invisible spectator. Its purpose is to keep track of
-# 'game-state', that is, what each player's role is,
-# and the actions they are performing. If not for this,
-# the players would not be able to keep secrets.
-class GameConsumer(SyncConsumer):
-    players = {}
-    roles = ["King", "Guard", "Guard", "Guard", "Guard", "Beast"]
-    lobby = True
-    game_over = False
-    capacity = 6
-    player_count = 0
-    votes = 0
-    random.shuffle(roles)
-    lobby_name = ""
-    group = ""
-
-    def connect(self, event):
+    async def connect(self, event):
         username = event["username"]
+        game = self.games.open(event["id"])
         print(username + " joined")
 
-        # Game connection in lobby phase
-        if self.lobby:
-            if self.player_count == 0:
-                self.lobby_name = event["id"]
-                self.group = "palace_%s" % event["id"]
+        # Whoever comes in while a full lobby counts down watches,
+        # the game starts with the players it has
+        if game.lobby and game.countdown is not None and username not in game.players:
+            game.players[username] = Player(event["player_channel"])
+            game.players[username].spectator = True
 
-            self.players[username] = Player(event["player_channel"])
+        # Back on a new socket, say after a reload. The old socket's
+        # disconnect may come later, it's told apart by its channel.
+        elif game.lobby and username in game.players:
+            game.players[username].channel = event["player_channel"]
 
-            self.group_message(
-                {
-                    "type": "refresh_lobby",
-                },
-            )
-            self.player_count += 1
+            if not game.players[username].spectator:
+                self.player_writes.join(game.lobby_name, username)
 
-            if self.player_count == self.capacity:
-                print("what")
-                sleep(1)
-
-                self.group_message(
-                    {
-                        "type": "game_event",
-                        "event": "beginning",
-                        "message": "Game beginning!",
-                        "theme": "primary",
-                    },
-                )
-
-                sleep(5)
+        # Game connection in lobby phase
+        elif game.lobby:
+            game.players[username] = Player(event["player_channel"])
+            await self.roster_changed(game, "join", username)
 
-                self.lobby = False
+            # If a socket that closed first gave the seat back, it's taken again
+            self.player_writes.join(game.lobby_name, username)
 
-                self.group_message(
-                    {
-                        "type": "assigned_roles",
-                    },
-                )
+            if game.player_count == game.capacity and game.countdown is None:
+                game.countdown = self.later(game, 1, self.begin)
 
         # Game connection of game in-progress
         else:
-            if username in self.players:
+            if username in game.players:
                 # a player has reconnected
-                if not self.players[username].connected:
-                    self.group_message(
+                if not game.players[username].connected:
+                    await self.group_message(
+                        game,
                         {
                             "type": "game_event",
                             "event": "reconnected",
                             "player": username,
                         },
                     )
-                    self.players[username].connected = True
+                    game.players[username].connected = True
 
             else:
                 # a spectator has joined
-                self.players[username] = Player(event["player_channel"])
-                self.players[username].spectator = True
+                game.players[username] = Player(event["player_channel"])
+                game.players[username].spectator = True
+
+        # Whoever connected gets the whole list, after that just changes
+        await self.send_roster(game, event["player_channel"])
+
+    # The lobby is full, a countdown starts before roles go out
+    async def begin(self, game):
+        if game.player_count < game.capacity:
+            game.countdown = None
+            return None
+
+        await self.group_message(
+            game,
+            {
+                "type": "game_event",
+                "event": "beginning",
+                "message": "Game beginning!",
+                "theme": "primary",
+            },
+        )
+
+        game.countdown = self.later(game, 5, self.assign_roles)
 
+    async def assign_roles(self, game):
+        game.countdown = None
 
-    def disconnect(self, event):
+        if game.player_count < game.capacity:
+            return None
+
+        game.lobby = False
+        self.player_writes.start(game.lobby_name)
+
+        await self.group_message(
+            game,
+            {
+                "type": "assigned_roles",
+            },
+        )
+
+    async def disconnect(self, event):
         username = event["username"]
-        player_model = models.Player.objects.get(player=username)
+        game = self.games.get(event["id"])
         print(username + " left")
 
+        if game is None:
+            return None
+
+        # A socket they've since replaced, they're still here
+        if game.lobby and username in game.players:
+            if game.players[username].channel != event["player_channel"]:
+                return None
+
         # Game Disconnection
-        if self.lobby:
-            if username in self.players:
-                del self.players[username]
+        if game.lobby:
+            player = game.players.pop(username, None)
 
-            player_model.ingame = None
-            player_model.save()
+            if player is not None and not player.spectator:
+                await self.roster_changed(game, "leave", username)
 
-            self.player_count -= 1
+            self.player_writes.leave(game.lobby_name, username)
 
-            self.group_message(
-                {
-                    "type": "refresh_lobby",
-                }
-            )
+            # A seat came free, the game waits until it's taken again
+            if game.countdown is not None and game.player_count < game.capacity:
+                game.countdown.cancel()
+                game.countdown = None
+
+                await self.group_message(
+                    game,
+                    {
+                        "type": "game_event",
+                        "event": "called_off",
+                        "message": "Someone left, waiting for the lobby to fill again",
+                        "theme": "secondary",
+                    },
+                )
 
         # Game Disconnection
-        else:
-            self.players[username].connected = False
+        elif username in game.players:
+            game.players[username].connected = False
 
-            self.group_message(
+            await self.group_message(
+                game,
                 {
                     "type": "game_event",
                     "event": "disconnected",
@@ -355,31 +414,59 @@ class GameConsumer(SyncConsumer):
                 },
             )
 
-            self.player_count -= 1
-
-        if self.player_count == 0:
-            self.message(
+        if game.player_count == 0:
+            await self.message(
                 {
                     "type": "delete_lobby",
                     "player_channel": event["player_channel"],
                 },
             )
-            models.Game.objects.get(lobby_name=self.lobby_name).delete()
-            self.lobby = True
-            self.roles = ["King", "Guard", "Guard", "Guard", "Guard", "Beast"]
-            random.shuffle(self.roles)
-            self.players = {}
-            self.votes = 0
-            self.game_over = False
+            self.player_writes.close(game.lobby_name)
+            game.cancel_timers()
+            self.games.close(game.lobby_name)
+
+    # Tell the lobby one name was added to or taken off its list
+    async def roster_changed(self, game, op, username):
+        game.roster_version += 1
+
+        await self.group_message(
+            game,
+            {
+                "type": "roster",
+                "op": op,
+                "version": game.roster_version,
+                "players": [username],
+            },
+        )
+
+    async def send_roster(self, game, player_channel):
+        await self.message(
+            {
+                "type": "roster",
+                "player_channel": player_channel,
+                "op": "full",
+                "version": game.roster_version,
+                "players": game.roster(),
+            },
+        )
 
     # The lobby has filled, the game begins.
-    def init_game(self, event):
+    async def init_game(self, event):
+        game = self.games.get(event["id"])
         character = event["player"]
-        role = self.roles.pop()
 
-        self.players[character].role = role
+        # Nothing to hand out to a name the game doesn't know. Spectators
+        # get no role, and a player's other tabs don't get another one.
+        if game is None or character not in game.players or not game.roles:
+            return None
 
-        self.message(
+        if game.players[character].spectator or game.players[character].role:
+            return None
+
+        role = game.roles.pop()
+        game.players[character].role = role
+
+        await self.message(
             {
                 "type": "game_event",
                 "player_channel": event["player_channel"],
@@ -388,7 +475,7 @@ class GameConsumer(SyncConsumer):
             },
         )
 
-        self.message(
+        await self.message(
             {
                 "type": "game_event",
                 "player_channel": event["player_channel"],
@@ -398,21 +485,21 @@ class GameConsumer(SyncConsumer):
             },
         )
 
-        if not self.roles:
-            self.tell_guards()
+        if not game.roles:
+            await self.tell_guards(game)
 
     #  Think of each player in the game running this function
-    def tell_guards(self):
+    async def tell_guards(self, game):
         king = ""
 
-        for name, player in self.players.items():
+        for name, player in game.players.items():
             if player.role == "King":
                 king = name
 
         # Their role is checked
-        for player in self.players.values():
+        for player in game.players.values():
             if player.role == "Guard":
-                self.message(
+                await self.message(
                     {
                         "type": "game_event",
                         "player_channel": player.channel,
@@ -421,7 +508,7 @@ class GameConsumer(SyncConsumer):
                         "role": "King",
                     },
                 )
-                self.message(
+                await self.message(
                     {
                         "type": "game_message",
                         "player_channel": player.channel,
@@ -430,49 +517,76 @@ class GameConsumer(SyncConsumer):
                     },
                 )
 
-        sleep(5)
-        self.cycle()
+        self.later(game, 5, self.cycle)
 
-    def demand(self, event):
+    async def demand(self, event):
+        game = self.games.get(event["id"])
         demand = event["demand"]
         msg = event["message"]
         username = event["username"]
 
+        if game is None:
+            return None
+
         if demand == "c":
-            self.vote(msg)
+            await self.vote(game, msg)
             return None
         elif demand == "v":
-            self.voted(msg, username)
+            await self.voted(game, msg, username)
             return None
         elif demand == "j":
-            self.jump(msg)
+            await self.jump(game, msg, username)
             return None
+        elif demand == "r":
+            # The client missed a roster change
+            await self.send_roster(game, event["player_channel"])
+            return None
+
+    async def voted(self, game, player, voter):
+        message = voter + " voted for " + player
+        record_vote(game.lobby_name, voter, message)
 
-    def voted(self, player, voter):
-        self.group_message(
+        await self.group_message(
+            game,
             {
                 "type": "game_message",
-                "message": voter + " voted for " + player,
+                "message": message,
                 "theme": "success",
             },
+            status=False,
         )
 
-    def vote(self, player):
+    # Names come from the client, one that isn't playing is ignored
+    async def vote(self, game, player):
         voted = player
-        self.players[voted].votes += 1
-        self.votes += 1
-        print(voted + " has " + str(self.players[voted].votes) + " votes")
+
+        if voted not in game.players:
+            return None
+
+        game.players[voted].votes += 1
+        game.votes += 1
+        print(voted + " has " + str(game.players[voted].votes) + " votes")
 
         # If everyone has voted:
-        if self.votes == self.capacity:
-            self.tally()
-            self.votes = 0
+        if game.votes == game.capacity:
+            await self.tally(game)
+            game.votes = 0
 
-    def jump(self, player):
+    # Only the Beast jumps, and only once the game is under way
+    async def jump(self, game, player, jumper):
         jumped = player
-        role = self.players[jumped].role
+        beast = game.players.get(jumper)
+
+        if game.lobby or game.game_over or jumped not in game.players:
+            return None
+
+        if beast is None or beast.spectator or beast.role != "Beast":
+            return None
 
-        self.group_message(
+        role = game.players[jumped].role
+
+        await self.group_message(
+            game,
             {
                 "type": "game_message",
                 "message": "The " + role + " " + jumped + " has been jumped on!",
@@ -481,7 +595,9 @@ class GameConsumer(SyncConsumer):
         )
 
         if role == "King":
-            self.group_message(
+            winners = ("Beast",)
+            await self.group_message(
+                game,
                 {
                     "type": "game_message",
                     "message": "The beast wins!",
@@ -489,7 +605,9 @@ class GameConsumer(SyncConsumer):
                 },
             )
         else:
-            self.group_message(
+            winners = ("King", "Guard")
+            await self.group_message(
+                game,
                 {
                     "type": "game_message",
                     "message": "The palace team wins!",
@@ -497,40 +615,49 @@ class GameConsumer(SyncConsumer):
                 },
             )
 
-        self.game_over = True
+        self.player_writes.win(
+            game.lobby_name,
+            [name for name, player in game.players.items() if player.role in winners],
+        )
+
+        game.game_over = True
+        game.cancel_timers()
 
-    def tally(self):
+    async def tally(self, game):
         votes = 0
         voted = ""
 
-        if self.game_over:
+        if game.game_over:
             return None
 
-        for i, name in enumerate(self.players):
-            if self.players[name].votes > votes:
-                votes = self.players[name].votes
+        for name, player in game.players.items():
+            if player.votes > votes:
+                votes = player.votes
                 voted = name
 
-        self.group_message(
+        await self.group_message(
+            game,
             {
                 "type": "game_message",
                 "message": voted
                 + " has been voted out!"
                 + " He was "
-                + self.players[voted].role,
+                + game.players[voted].role,
                 "theme": "danger",
             },
         )
         # add personal role
-        self.group_message(
+        await self.group_message(
+            game,
             {
                 "type": "game_event",
-                "update": "out",
+                "event": "out",
                 "player": voted,
             },
         )
 
-        self.group_message(
+        await self.group_message(
+            game,
             {
                 "type": "game_message",
                 "message": "New cycle beginning in 5 seconds",
@@ -538,12 +665,11 @@ class GameConsumer(SyncConsumer):
             },
         )
 
-        sleep(5)
-
-        self.cycle()
+        self.later(game, 5, self.cycle)
 
-    def cycle(self):
-        self.group_message(
+    async def cycle(self, game):
+        await self.group_message(
+            game,
             {
                 "type": "game_event",
                 "event": "new_cycle",
@@ -552,25 +678,64 @@ class GameConsumer(SyncConsumer):
             },
         )
 
-        Timer(
-            50.0,
-            self.group_message,
-            [
-                {
-                    "type": "game_message",
-                    "theme": "light",
-                    "message": "Cycle finished! Counting votes.",
-                },
-            ],
-        ).start()
-
-
+        self.later(game, 50, self.end_cycle)
 
-    def message(self, event):
-        async_to_sync(self.channel_layer.send)(
-            event["player_channel"],
-            event,
+    async def end_cycle(self, game):
+        await self.group_message(
+            game,
+            {
+                "type": "game_message",
+                "theme": "light",
+                "message": "Cycle finished! Counting votes.",
+            },
         )
 
-    def group_message(self, event):
-        async_to_sync(self.channel_layer.group_send)(self.group, event)
+    # Run one of the game's phases after a delay. The game keeps the
+    # timer so the phase can be called off if the game ends first
+    def later(self, game, delay, phase):
+        game.timers = [(name, timer) for name, timer in game.timers if timer.pending]
+        timer = self.scheduler.call_later(delay, self.run_phase, game, phase)
+        game.timers.append((phase.__name__, timer))
+        return timer
+
+    async def run_phase(self, game, phase):
+        await phase(game)
+        await self.flush_outbox()
+        self.save(game.lobby_name)
+
+    # Messages are held in the outbox until the event that caused
+    # them has been handled, then flush_outbox sends each channel
+    # and group everything it got in one go
+    async def message(self, event):
+        self.outbox.setdefault((False, event["player_channel"]), []).append(event)
+
+    # Broadcasts with a message go in the game's log as status lines
+    async def group_message(self, game, event, status=True):
+        self.outbox.setdefault((True, game.group), []).append(event)
+
+        if status and "message" in event:
+            record_status(game.lobby_name, event["message"])
+
+    # Client frames for a target are encoded once, together, however
+    # many sockets they go out to. Other messages, like assigned_roles,
+    # are for the consumers themselves and are sent as they are.
+    async def flush_outbox(self):
+        outbox, self.outbox = self.outbox, {}
+
+        for (group, target), events in outbox.items():
+            send = self.channel_layer.group_send if group else self.channel_layer.send
+            frames = []
+
+            for event in events:
+                if event["type"] in protocol.CLIENT_FRAMES:
+                    frames.append(protocol.client_frame(event))
+                    continue
+
+                if frames:
+                    await send(target, protocol.frame_message(frames))
+                    frames = []
+
+                await send(target, event)
+
+            if frames:
+                await send(target, protocol.frame_message(frames))
@@ -0,0 +1,153 @@
+import random
+
+ROLES = ("King", "Guard", "Guard", "Guard", "Guard", "Beast")
+
+
+# The moderator's view of one person connected to a lobby.
+# __slots__ keeps each of these small, a moderator can hold
+# a lot of them when it runs many games at once
+class Player:
+    __slots__ = ("channel", "out", "connected", "spectator", "role", "votes")
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.out = False
+        self.connected = True
+        self.spectator = False
+        self.role = ""
+        self.votes = 0
+
+    def to_state(self):
+        return [self.channel, self.out, self.connected, self.spectator, self.role, self.votes]
+
+    @classmethod
+    def from_state(cls, state):
+        player = cls.__new__(cls)
+        (
+            player.channel,
+            player.out,
+            player.connected,
+            player.spectator,
+            player.role,
+            player.votes,
+        ) = state
+        return player
+
+
+# Everything the moderator knows about a single lobby
+class Game:
+    __slots__ = (
+        "lobby_name",
+        "group",
+        "players",
+        "roles",
+        "lobby",
+        "game_over",
+        "capacity",
+        "votes",
+        "timers",
+        "countdown",
+        "roster_version",
+    )
+
+    def __init__(self, lobby_name, capacity=6):
+        self.lobby_name = lobby_name
+        self.group = "palace_%s" % lobby_name
+        self.players = {}
+        self.roles = list(ROLES)
+        random.shuffle(self.roles)
+        self.lobby = True
+        self.game_over = False
+        self.capacity = capacity
+        self.votes = 0
+        self.timers = []
+        # The pending begin or assign_roles while the full lobby counts down
+        self.countdown = None
+        self.roster_version = 0
+
+    # Seated players still connected, spectators don't count
+    @property
+    def player_count(self):
+        return sum(
+            1 for player in self.players.values() if player.connected and not player.spectator
+        )
+
+    # The names listed in the lobby, spectators aren't on it
+    def roster(self):
+        return sorted(name for name, player in self.players.items() if not player.spectator)
+
+    # Drop every pending phase, used once the game is over
+    def cancel_timers(self):
+        for phase, timer in self.timers:
+            timer.cancel()
+
+        self.timers = []
+        self.countdown = None
+
+    # A compact, JSON friendly copy of the game. Pending phases are
+    # kept as the wall clock times they're due, so another process can
+    # pick them up, and an unchanged game gives an unchanged copy.
+    def to_state(self):
+        return {
+            "lobby": self.lobby,
+            "game_over": self.game_over,
+            "capacity": self.capacity,
+            "votes": self.votes,
+            "roster_version": self.roster_version,
+            "roles": list(self.roles),
+            "players": {name: player.to_state() for name, player in self.players.items()},
+            "timers": [
+                [phase, round(timer.due(), 3)]
+                for phase, timer in self.timers
+                if timer.pending
+            ],
+        }
+
+    # Timers are left to the moderator, they need its scheduler
+    @classmethod
+    def from_state(cls, lobby_name, state):
+        game = cls.__new__(cls)
+        game.lobby_name = lobby_name
+        game.group = "palace_%s" % lobby_name
+        game.capacity = state["capacity"]
+        game.lobby = state["lobby"]
+        game.game_over = state["game_over"]
+        game.votes = state["votes"]
+        game.roster_version = state.get("roster_version", 0)
+        game.roles = list(state["roles"])
+        game.players = {
+            name: Player.from_state(player) for name, player in state["players"].items()
+        }
+        game.timers = []
+        game.countdown = None
+        return game
+
+
+# All the games one moderator is running, keyed by lobby name
+class GameRegistry:
+    def __init__(self):
+        self.games = {}
+
+    def __len__(self):
+        return len(self.games)
+
+    def __contains__(self, lobby_name):
+        return lobby_name in self.games
+
+    def get(self, lobby_name):
+        return self.games.get(lobby_name)
+
+    # Find the game for a lobby, starting one if this is its first player
+    def open(self, lobby_name):
+        game = self.games.get(lobby_name)
+
+        if game is None:
+            game = self.games[lobby_name] = Game(lobby_name)
+
+        return game
+
+    def close(self, lobby_name):
+        self.games.pop(lobby_name, None)
+
+    def add(self, game):
+        self.games[game.lobby_name] = game
@@ -0,0 +1,112 @@
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+
+from . import models
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+# A lobby's log as the page shows it: who said it ("" for the
+# moderator's lines, votes included) and what was said
+def line(row):
+    timestamp, id, sender, message, is_vote, is_status = row
+
+    if is_vote or is_status:
+        sender = None
+
+    return [sender or "", message]
+
+
+# Cursors look like "<microseconds since the epoch>.<id>" of the oldest
+# line a client has, anything else is treated as having none
+def cursor(row):
+    return "%d.%d" % ((row[0] - EPOCH) // MICROSECOND, row[1])
+
+
+def parse_cursor(value):
+    microseconds, dot, id = value.partition(".")
+
+    if not (microseconds.isdigit() and dot and id.isdigit()):
+        return None
+
+    return EPOCH + timedelta(microseconds=int(microseconds)), int(id)
+
+
+# The last lines of each lobby's log, kept in a ring buffer per game.
+# Replaying a log on connect only asks the database for what was
+# written after the newest line held, one seek into the game's
+# (game, timestamp, id) index, so it costs the same however long the
+# game has gone on. Older lines are read a page at a time before a
+# cursor, also by seeking.
+# Lines are written by other processes too, the buffers only ever
+# hold what's already in the Game_Message table.
+class History:
+    def __init__(self, size=50, max_games=1000):
+        self.size = size
+        self.max_games = max_games
+        self.logs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def rows(self, game_id):
+        return (
+            models.Game_Message.objects.filter(game_id=game_id, private_recipient=None)
+            .order_by("-timestamp", "-id")
+            .values_list("timestamp", "id", "sender__player", "message", "is_vote", "is_status")
+        )
+
+    def game_id(self, lobby_name):
+        return (
+            models.Game.objects.filter(lobby_name=lobby_name).values_list("pk", flat=True).first()
+        )
+
+    # The newest lines of a lobby's log, oldest first, and a cursor
+    # for the page before them if there might be one
+    def recent(self, lobby_name):
+        game_id = self.game_id(lobby_name)
+
+        if game_id is None:
+            return [], None
+
+        with self.lock:
+            log = self.logs.pop(game_id, None)
+
+        if log is None:
+            log = deque(reversed(self.rows(game_id)[: self.size]), self.size)
+        elif log:
+            newest = log[-1][:2]
+            # Lines at the newest one's exact time are the only ones
+            # the range can't tell apart, the id does
+            rows = self.rows(game_id).filter(timestamp__gte=newest[0])[: self.size]
+            log.extend(reversed([row for row in rows if row[:2] > newest]))
+        else:
+            log.extend(reversed(self.rows(game_id)[: self.size]))
+
+        with self.lock:
+            self.logs[game_id] = log
+
+            while len(self.logs) > self.max_games:
+                self.logs.popitem(last=False)
+
+        return [line(row) for row in log], cursor(log[0]) if len(log) == self.size else None
+
+    # The page of lines before a cursor, oldest first
+    def before(self, lobby_name, value):
+        game_id = self.game_id(lobby_name)
+        position = parse_cursor(value)
+
+        if game_id is None or position is None:
+            return [], None
+
+        timestamp, id = position
+        rows = list(self.rows(game_id).filter(timestamp=timestamp, id__lt=id)[: self.size])
+
+        if len(rows) < self.size:
+            rows += self.rows(game_id).filter(timestamp__lt=timestamp)[: self.size - len(rows)]
+
+        rows.reverse()
+        return [line(row) for row in rows], cursor(rows[0]) if len(rows) == self.size else None
+
+
+history = History()
@@ -0,0 +1,347 @@
+import asyncio
+import fnmatch
+import logging
+import re
+import time
+from collections import Counter, OrderedDict, deque
+
+from channels.exceptions import ChannelFull
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from . import protocol
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("coalesce", "drop_chat", "disconnect")
+
+CLASSES = {
+    "chat": {"capacity": 100, "expiry": 10},
+    "game": {"capacity": 1000, "expiry": 60},
+}
+
+
+def make_layer(config):
+    return import_string(config["BACKEND"])(**config.get("CONFIG", {}))
+
+
+# Frames that are only chat can be lost without breaking a game,
+# everything else is part of it
+def message_class(message):
+    return "chat" if message.get("chat") else "game"
+
+
+# What one socket's consumer has still to handle. Each entry is
+# [class, time sent, messages], more than one message once coalesced.
+class ChannelBuffer:
+    def __init__(self):
+        self.entries = deque()
+        self.counts = Counter()
+        self.ready = asyncio.Event()
+        self.slow = False
+        self.overflowed = False
+        self.pump = None
+        self.error = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, kind, sent_at, message):
+        self.entries.append([kind, sent_at, [message]])
+        self.counts[kind] += 1
+        self.ready.set()
+
+
+# Wraps another channel layer, given as a CHANNEL_LAYERS style entry,
+# and keeps count of what happens to every message sent through it.
+# Messages for sockets in this process are taken off the layer as soon
+# as they arrive, so it never fills up and drops them unnoticed, and
+# wait here instead, each class up to its own capacity and expiry.
+# A socket with more than slow_depth messages waiting is slow, and the
+# policy decides what happens to the next ones:
+#   coalesce - frames are added to the last one waiting, the socket
+#       gets them all in one batch
+#   drop_chat - chat is dropped, game events still wait their turn
+#   disconnect - everything waiting is dropped and the socket closed
+# stats() has depth, drops and expiries by channel and by group,
+# for the sockets and groups in this process.
+class InstrumentedChannelLayer:
+    def __init__(self, layer, policy="drop_chat", slow_depth=50, classes=None, max_groups=1000):
+        if policy not in POLICIES:
+            raise ImproperlyConfigured(
+                "Unknown slow socket policy %r, use one of %s" % (policy, ", ".join(POLICIES))
+            )
+
+        self.layer = make_layer(layer)
+        self.policy = policy
+        self.slow_depth = slow_depth
+        self.classes = dict(CLASSES, **(classes or {}))
+        self.max_groups = max_groups
+        self.sockets = set()
+        self.buffers = {}
+        self.members = {}
+        self.channel_stats = {}
+        self.group_stats = OrderedDict()
+        self.totals = Counter()
+
+    # Anything else a layer has, like extensions
+    def __getattr__(self, name):
+        return getattr(self.layer, name)
+
+    def count(self, key, channel=None, group=None, amount=1):
+        self.totals[key] += amount
+
+        if channel in self.channel_stats:
+            self.channel_stats[channel][key] += amount
+
+        if group is not None:
+            self.group_stats.setdefault(group, Counter())[key] += amount
+            self.group_stats.move_to_end(group)
+
+            while len(self.group_stats) > self.max_groups:
+                self.group_stats.popitem(last=False)
+
+    # Consumers get their channel here, those are the ones buffered
+    async def new_channel(self, prefix="specific."):
+        channel = await self.layer.new_channel(prefix)
+        self.sockets.add(channel)
+        return channel
+
+    async def send(self, channel, message):
+        try:
+            await self.layer.send(channel, dict(message, sent_at=time.time()))
+        except ChannelFull:
+            self.full(channel, message)
+            return None
+
+        self.count("sent", channel)
+
+    # A channel with no room left loses the message, like a slow
+    # socket's buffer would, and the sender carries on with its other
+    # targets instead of failing. Lost chat is expected and only
+    # counted, a lost game event is logged, and under "disconnect" a
+    # socket of this process that lost one is closed to start over.
+    def full(self, channel, message):
+        kind = message_class(message)
+        buffer = self.buffers.get(channel)
+        self.count("dropped", channel)
+
+        if kind == "chat":
+            logger.debug("Channel %s is full, a chat message was dropped", channel)
+            return None
+
+        logger.warning("Channel %s is full, a game message was dropped", channel)
+
+        if self.policy == "disconnect" and buffer is not None and not buffer.overflowed:
+            self.overflow(channel, buffer)
+
+    async def group_send(self, group, message):
+        await self.layer.group_send(group, dict(message, sent_at=time.time(), sent_to=group))
+        self.count("sent", group=group)
+
+    async def group_add(self, group, channel):
+        await self.layer.group_add(group, channel)
+        self.members.setdefault(group, set()).add(channel)
+
+    async def group_discard(self, group, channel):
+        await self.layer.group_discard(group, channel)
+        members = self.members.get(group, set())
+        members.discard(channel)
+
+        if not members:
+            self.members.pop(group, None)
+
+    # Moderator channels are read straight from the layer, a socket's
+    # through its buffer. A consumer stops by cancelling its receive,
+    # its buffer goes with it.
+    async def receive(self, channel):
+        if channel not in self.sockets:
+            return await self.layer.receive(channel)
+
+        buffer = self.buffers.get(channel)
+
+        if buffer is None:
+            buffer = self.buffers[channel] = ChannelBuffer()
+            self.channel_stats[channel] = Counter()
+            buffer.pump = asyncio.ensure_future(self.pump(channel, buffer))
+
+        try:
+            return await self.take(channel, buffer)
+        except asyncio.CancelledError:
+            self.close(channel)
+            raise
+
+    async def pump(self, channel, buffer):
+        try:
+            while True:
+                self.arrived(channel, buffer, await self.layer.receive(channel))
+        except Exception as error:
+            buffer.error = error
+            buffer.ready.set()
+
+    def arrived(self, channel, buffer, message):
+        kind = message_class(message)
+        group = message.get("sent_to")
+
+        if buffer.overflowed:
+            self.count("dropped", channel, group)
+            return None
+
+        if len(buffer) >= self.slow_depth:
+            if not buffer.slow:
+                buffer.slow = True
+                self.count("slow", channel, group)
+                logger.warning(
+                    "Channel %s has %d messages waiting, applying %s",
+                    channel,
+                    len(buffer),
+                    self.policy,
+                )
+
+            if self.policy == "disconnect":
+                self.overflow(channel, buffer)
+                self.count("dropped", channel, group)
+                return None
+
+            if self.policy == "drop_chat" and kind == "chat":
+                self.count("dropped", channel, group)
+                return None
+
+            last = buffer.entries[-1]
+
+            if self.policy == "coalesce" and message["type"] == last[2][0]["type"] == "frame":
+                if kind == "game" and last[0] == "chat":
+                    buffer.counts["chat"] -= 1
+                    buffer.counts["game"] += 1
+                    last[0] = "game"
+
+                last[2].append(message)
+                self.count("coalesced", channel, group)
+                return None
+
+        if buffer.counts[kind] >= self.classes[kind]["capacity"]:
+            self.count("dropped", channel, group)
+            return None
+
+        buffer.append(kind, message.get("sent_at", time.time()), message)
+        stats = self.channel_stats[channel]
+        stats["peak"] = max(stats["peak"], len(buffer))
+
+    # Everything waiting is dropped, the consumer is told to close next
+    def overflow(self, channel, buffer):
+        for kind, sent_at, messages in buffer.entries:
+            for message in messages:
+                self.count("dropped", channel, message.get("sent_to"))
+
+        buffer.entries.clear()
+        buffer.counts.clear()
+        buffer.overflowed = True
+        buffer.append("game", time.time(), {"type": "layer.overflow"})
+
+    async def take(self, channel, buffer):
+        while True:
+            while not buffer.entries:
+                if buffer.error is not None:
+                    raise buffer.error
+
+                buffer.ready.clear()
+                await buffer.ready.wait()
+
+            kind, sent_at, messages = buffer.entries.popleft()
+            buffer.counts[kind] -= 1
+
+            if buffer.slow and len(buffer) <= self.slow_depth // 2:
+                buffer.slow = False
+
+            if time.time() - sent_at > self.classes[kind]["expiry"]:
+                for message in messages:
+                    self.count("expired", channel, message.get("sent_to"))
+                continue
+
+            self.count("delivered", channel, amount=len(messages))
+
+            if len(messages) == 1:
+                return messages[0]
+
+            return protocol.join_frame_messages(messages)
+
+    def close(self, channel):
+        self.sockets.discard(channel)
+        buffer = self.buffers.pop(channel, None)
+        self.channel_stats.pop(channel, None)
+
+        if buffer is not None:
+            buffer.pump.cancel()
+
+    async def flush(self):
+        for channel in list(self.buffers):
+            self.close(channel)
+
+        self.sockets.clear()
+        self.members.clear()
+        await self.layer.flush()
+
+    def stats(self):
+        return {
+            "totals": dict(self.totals),
+            "channels": {
+                channel: dict(self.channel_stats[channel], depth=len(buffer), slow=buffer.slow)
+                for channel, buffer in self.buffers.items()
+            },
+            "groups": {
+                group: dict(
+                    stats,
+                    depth=sum(
+                        len(self.buffers[channel])
+                        for channel in self.members.get(group, ())
+                        if channel in self.buffers
+                    ),
+                )
+                for group, stats in self.group_stats.items()
+            },
+        }
+
+
+# Groups and sockets' own channels over one layer, meant for Redis
+# pub/sub, and channels matching the queued patterns over another,
+# Redis lists. A broadcast is then one publish however big the lobby,
+# where the list layer writes to every member's channel. The moderators'
+# channels stay on lists: pub/sub drops what's published while nobody
+# is subscribed, a moderator restarting would lose demands, a list
+# keeps them until it's back. The moderator's own sends to a player's
+# channel go over pub/sub, that socket is always listening.
+class HybridChannelLayer:
+    extensions = ["groups", "flush"]
+
+    def __init__(self, broadcast, queued, queued_channels=("moderator.*",)):
+        self.broadcast = make_layer(broadcast)
+        self.queued = make_layer(queued)
+        self.queued_channels = [re.compile(fnmatch.translate(pattern)) for pattern in queued_channels]
+
+    def layer_for(self, channel):
+        if any(pattern.match(channel) for pattern in self.queued_channels):
+            return self.queued
+
+        return self.broadcast
+
+    async def send(self, channel, message):
+        await self.layer_for(channel).send(channel, message)
+
+    async def receive(self, channel):
+        return await self.layer_for(channel).receive(channel)
+
+    async def new_channel(self, prefix="specific."):
+        return await self.broadcast.new_channel(prefix)
+
+    async def group_add(self, group, channel):
+        await self.broadcast.group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await self.broadcast.group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        await self.broadcast.group_send(group, message)
+
+    async def flush(self):
+        await self.broadcast.flush()
+        await self.queued.flush()
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+# Every web process has a channel in this group, the moderators send
+# it players' new win counts as they're written
+GROUP = "leaderboard"
+
+
+# Players ranked by wins, most first, kept as a sorted list of
+# (-wins, name) next to a dict of everyone's wins. A win moves one
+# entry with two binary searches, reading the top N is a slice and
+# a player's rank is one binary search, so nothing is ever sorted
+# by the database.
+# The list is loaded from the Player table the first time it's read.
+# After that the wins moderators write reach it through the channel
+# layer (see FollowWins) and are applied one player at a time. A
+# process that isn't following them, one served over WSGI, loads the
+# list again once it's older than max_age.
+class Leaderboard:
+    def __init__(self, max_age=60, clock=time.monotonic):
+        self.max_age = max_age
+        self.clock = clock
+        self.entries = []
+        self.wins = {}
+        self.loaded = None
+        self.following = False
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, rows):
+        wins = dict(rows)
+
+        with self.lock:
+            self.wins = wins
+            self.entries = sorted((-count, name) for name, count in wins.items())
+            self.loaded = self.clock()
+
+    def warm(self):
+        if self.loaded is None or (
+            not self.following and self.clock() - self.loaded > self.max_age
+        ):
+            self.load(models.Player.objects.values_list("player", "wins"))
+
+    def set(self, name, wins):
+        with self.lock:
+            old = self.wins.get(name)
+
+            if old is not None:
+                del self.entries[bisect_left(self.entries, (-old, name))]
+
+            insort(self.entries, (-wins, name))
+            self.wins[name] = wins
+
+    # Players' win counts as they now are in the database. Nothing to
+    # do until the list has been read once, it's loaded with them.
+    def update(self, rows):
+        if self.loaded is None:
+            return None
+
+        for name, wins in rows:
+            self.set(name, wins)
+
+    # Read under the lock too, a player being moved is briefly out of
+    # the list while FollowWins applies wins from another thread
+    def top(self, count):
+        with self.lock:
+            return [(name, -wins) for wins, name in self.entries[:count]]
+
+    # Players on the same number of wins share a rank
+    def rank(self, name):
+        with self.lock:
+            wins = self.wins.get(name)
+
+            if wins is None:
+                return None
+
+            return bisect_left(self.entries, (-wins, "")) + 1
+
+
+leaderboard = Leaderboard()
+
+
+# Sent by the moderator once wins are written, from its write thread
+def publish(rows):
+    if rows:
+        async_to_sync(get_channel_layer().group_send)(
+            GROUP, {"type": "leaderboard.wins", "wins": [list(row) for row in rows]}
+        )
+
+
+# Wraps the ASGI application so the process's leaderboard follows the
+# wins sent to the group, from the first scope the server hands over.
+# Membership is renewed well before the layer's group expiry. Whatever
+# was sent before this process joined is in the list it loads after.
+class FollowWins:
+    renew = 3600
+
+    def __init__(self, application, board=None):
+        self.application = application
+        self.board = board if board is not None else leaderboard
+        self.task = None
+
+    async def __call__(self, scope, receive, send):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.follow())
+            self.task.add_done_callback(self.stopped)
+
+        return await self.application(scope, receive, send)
+
+    async def follow(self):
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(GROUP, channel)
+        rejoin = asyncio.ensure_future(self.rejoin(layer, channel))
+
+        self.board.following = True
+        self.board.loaded = None
+
+        try:
+            while True:
+                message = await layer.receive(channel)
+
+                if message.get("type") == "leaderboard.wins":
+                    self.board.update(message["wins"])
+        finally:
+            self.board.following = False
+            rejoin.cancel()
+
+    async def rejoin(self, layer, channel):
+        while True:
+            await asyncio.sleep(self.renew)
+            await layer.group_add(GROUP, channel)
+
+    def stopped(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Stopped following leaderboard wins", exc_info=task.exception())
@@ -0,0 +1,676 @@
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from channels.layers import InMemoryChannelLayer
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, connection, connections
+from django.db.models import F
+from django.test import RequestFactory, override_settings
+from django.utils.module_loading import import_string
+from redis.exceptions import RedisError
+
+from palace import auth, models, protocol
+from palace.layers import make_layer
+from palace.game import Game, GameRegistry, Player
+from palace.persistence import MessageBuffer, PlayerWriteQueue
+from palace.snapshots import SnapshotStore
+from palace.timers import TimingWheel
+from palace.views import GameIndexView, take_seat
+
+
+# A throwaway copy of the database, on disk so writes cost what they
+# would in production, removed again afterwards
+@contextmanager
+def scratch_database():
+    directory = tempfile.TemporaryDirectory()
+    name = connection.settings_dict["NAME"]
+
+    if connection.vendor == "sqlite":
+        connection.settings_dict["TEST"]["NAME"] = os.path.join(directory.name, "bench.sqlite3")
+
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(name, verbosity=0)
+        directory.cleanup()
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def ms(seconds):
+    return "%.3f ms" % (seconds * 1000)
+
+
+# Insert, cancel and fire cost of the moderator's timing wheel,
+# and how late deadlines fire against the real clock
+def bench_timers(command, options):
+    pending = options["count"] or 50000
+    rng = random.Random(1)
+    wheel = TimingWheel()
+
+    started = time.perf_counter()
+    timers = [wheel.schedule(rng.uniform(0, 60), None) for _ in range(pending)]
+    inserted = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for timer in timers:
+        timer.cancel()
+    cancelled = time.perf_counter() - started
+
+    command.stdout.write(
+        "%d deadlines: insert %.0f ns each, cancel %.0f ns each"
+        % (pending, inserted / pending * 1e9, cancelled / pending * 1e9)
+    )
+
+    late = []
+
+    def fire(due):
+        late.append(time.monotonic() - due)
+
+    async def run():
+        # Start after the inserts are done so they don't count as lateness
+        for _ in range(pending):
+            delay = rng.uniform(1, 6)
+            wheel.schedule(delay, fire, time.monotonic() + delay)
+
+        while len(wheel):
+            await asyncio.sleep(wheel.until_next_tick())
+            wheel.advance()
+
+    asyncio.run(run())
+    command.stdout.write(
+        "firing jitter over %d deadlines: median %s, p99 %s, max %s"
+        % (
+            len(late),
+            ms(statistics.median(late)),
+            ms(percentile(late, 0.99)),
+            ms(max(late)),
+        )
+    )
+
+
+# How long a moderator takes to rebuild its lobbies from disk
+def bench_snapshots(command, options):
+    lobbies = options["count"] or 10000
+    directory = tempfile.TemporaryDirectory()
+    path = os.path.join(directory.name, "snapshots.sqlite3")
+    store = SnapshotStore(path, "moderator.0")
+
+    for number in range(lobbies):
+        game = Game("lobby%d" % number)
+
+        for seat in range(6):
+            game.players["p%d" % seat] = Player("specific.p%d" % seat)
+
+        store.track(game.lobby_name, game.to_state())
+
+        # A few patches on top of each snapshot
+        for votes in range(1, 4):
+            game.votes = votes
+            game.players["p0"].votes = votes
+            store.track(game.lobby_name, game.to_state())
+
+    started = time.perf_counter()
+    store.flush()
+    command.stdout.write(
+        "wrote %d snapshots and %d patches in %s"
+        % (lobbies, lobbies * 3, ms(time.perf_counter() - started))
+    )
+
+    started = time.perf_counter()
+    games = GameRegistry()
+
+    for lobby_name, state in SnapshotStore(path, "moderator.0").load().items():
+        games.add(Game.from_state(lobby_name, state))
+
+    command.stdout.write(
+        "restored %d lobbies in %s" % (len(games), ms(time.perf_counter() - started))
+    )
+    directory.cleanup()
+
+
+# Saving each chat line as it is sent against the write-behind buffer
+def bench_messages(command, options):
+    count = options["count"] or 2000
+
+    with scratch_database():
+        game = models.Game.objects.create(lobby_name="bench")
+        sender = User.objects.create(username="bench").player
+
+        started = time.perf_counter()
+        for number in range(count):
+            models.Game_Message.objects.create(
+                game=game,
+                sender=sender,
+                chat_zone="game",
+                message="line %d" % number,
+                is_vote=False,
+                is_status=False,
+            )
+        saved = time.perf_counter() - started
+
+        command.stdout.write(
+            "per-message save: %s per message, %d in %s"
+            % (ms(saved / count), count, ms(saved))
+        )
+
+        async def buffered():
+            buffer = MessageBuffer()
+            waited = 0.0
+            started = time.perf_counter()
+
+            for number in range(count):
+                before = time.perf_counter()
+                buffer.add(("bench", "bench", "line %d" % number, False, False))
+                waited += time.perf_counter() - before
+
+            await buffer.drain()
+            return waited, time.perf_counter() - started
+
+        waited, total = asyncio.run(buffered())
+        command.stdout.write(
+            "write-behind: %s per message on the send path, %d written in %s"
+            % (ms(waited / count), count, ms(total))
+        )
+
+
+# Every player of every lobby dropping at once. Giving each seat back
+# in turn holds the moderator up for the whole time, the write queue
+# batches them behind its back.
+def bench_disconnects(command, options):
+    count = options["count"] or 1200
+
+    def seat_everyone():
+        models.Game.objects.all().delete()
+        models.Player.objects.update(ingame=None)
+        leaving = []
+
+        # The last lobby is only partly full when count isn't a multiple of 6
+        for number in range(0, count, 6):
+            names = ["bench%d" % seat for seat in range(number, min(number + 6, count))]
+            game = models.Game.objects.create(lobby_name="bench%d" % number, occupancy=len(names))
+            models.Player.objects.filter(player__in=names).update(ingame=game)
+            leaving += [(game.lobby_name, name) for name in names]
+
+        return leaving
+
+    with scratch_database():
+        User.objects.bulk_create([User(username="bench%d" % number) for number in range(count)])
+        models.Player.objects.bulk_create(
+            [
+                models.Player(user=user, player=user.username, wins=0)
+                for user in User.objects.all()
+            ]
+        )
+
+        started = time.perf_counter()
+        for lobby_name, username in seat_everyone():
+            player = models.Player.objects.get(player=username)
+            player.ingame = None
+            player.save()
+            models.Game.objects.filter(lobby_name=lobby_name).update(
+                occupancy=F("occupancy") - 1
+            )
+        command.stdout.write(
+            "one at a time: moderator blocked %s for %d leaves"
+            % (ms(time.perf_counter() - started), count)
+        )
+
+        leaving = seat_everyone()
+
+        async def queued():
+            queue = PlayerWriteQueue(max_delay=0.25)
+            depth = 0
+            started = time.perf_counter()
+
+            for lobby_name, username in leaving:
+                queue.leave(lobby_name, username)
+                depth = max(depth, queue.stats()["queued"])
+
+            blocked = time.perf_counter() - started
+
+            await queue.drain()
+
+            return blocked, depth, queue.stats()
+
+        blocked, depth, stats = asyncio.run(queued())
+        command.stdout.write(
+            "write queue: moderator blocked %s, deepest queue %d, %d batches,"
+            " slowest flush %s"
+            % (ms(blocked), depth, stats["batches"], ms(stats["max_latency"]))
+        )
+        assert not models.Player.objects.filter(ingame__isnull=False).exists()
+
+
+# Hundreds of players racing for the seats of one lobby, every join
+# on its own thread and database connection like concurrent requests
+def bench_joins(command, options):
+    count = options["count"] or 300
+
+    with scratch_database():
+        lobby = models.Game.objects.create(lobby_name="bench")
+        User.objects.bulk_create([User(username="bench%d" % number) for number in range(count)])
+        players = [
+            models.Player(user=user, player=user.username, wins=0)
+            for user in User.objects.all()
+        ]
+        models.Player.objects.bulk_create(players)
+
+        def join(player):
+            started = time.perf_counter()
+
+            try:
+                while True:
+                    try:
+                        return take_seat(player, lobby), time.perf_counter() - started
+                    except OperationalError:
+                        # SQLite gave up waiting for the write lock
+                        continue
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=64) as pool:
+            results = list(pool.map(join, players))
+        elapsed = time.perf_counter() - started
+
+        seated = sum(1 for taken, _ in results if taken)
+        lobby.refresh_from_db()
+        command.stdout.write(
+            "%d concurrent joins in %s: %d seated, occupancy %d of %d, %d players marked"
+            " in the lobby, join p50 %s, p99 %s"
+            % (
+                count,
+                ms(elapsed),
+                seated,
+                lobby.occupancy,
+                lobby.capacity,
+                models.Player.objects.filter(ingame=lobby).count(),
+                ms(percentile([took for _, took in results], 0.5)),
+                ms(percentile([took for _, took in results], 0.99)),
+            )
+        )
+
+
+# Concurrent joins spread over many lobbies, each thread a request
+# that seats a player and then reads the lobby list, under the SQLite
+# defaults and under the configured profile
+def bench_databases(command, options):
+    count = options["count"] or 600
+    threads = settings.ASGI_THREADS
+    database = connections.settings["default"]
+    profiles = [("configured (%s)" % connection.vendor, {}, settings.SQLITE_PRAGMAS)]
+
+    if connection.vendor == "sqlite":
+        defaults = {"OPTIONS": {}, "CONN_MAX_AGE": 0}
+        pragmas = ["journal_mode=DELETE", "synchronous=FULL"]
+        profiles.insert(0, ("sqlite defaults", defaults, pragmas))
+
+    for label, overrides, pragmas in profiles:
+        saved = {key: database[key] for key in overrides}
+        database.update(overrides)
+
+        try:
+            with override_settings(SQLITE_PRAGMAS=pragmas), scratch_database():
+                result = concurrent_joins(count, threads)
+        finally:
+            database.update(saved)
+
+        command.stdout.write(
+            "%s: %d joins on %d threads in %s, %.0f per second, p50 %s, p99 %s,"
+            " %d lock timeouts"
+            % (
+                label,
+                count,
+                threads,
+                ms(result["elapsed"]),
+                count / result["elapsed"],
+                ms(percentile(result["times"], 0.5)),
+                ms(percentile(result["times"], 0.99)),
+                result["timeouts"],
+            )
+        )
+
+
+def concurrent_joins(count, threads):
+    lobbies = models.Game.objects.bulk_create(
+        [models.Game(lobby_name="bench%d" % number) for number in range(count // 6 + 1)]
+    )
+    User.objects.bulk_create([User(username="bench%d" % number) for number in range(count)])
+    players = models.Player.objects.bulk_create(
+        [models.Player(user=user, player=user.username, wins=0) for user in User.objects.all()]
+    )
+    timeouts = []
+
+    def join(number):
+        started = time.perf_counter()
+
+        while True:
+            try:
+                take_seat(players[number], lobbies[number // 6])
+                list(models.Game.objects.open()[:21])
+                break
+            except OperationalError:
+                timeouts.append(number)
+            finally:
+                # The end of a request, connections are kept if CONN_MAX_AGE says so
+                close_old_connections()
+
+        return time.perf_counter() - started
+
+    # Every worker thread closes its own connection once all are done
+    barrier = threading.Barrier(threads)
+
+    def close(_):
+        barrier.wait()
+        connections.close_all()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        times = list(pool.map(join, range(count)))
+        elapsed = time.perf_counter() - started
+        list(pool.map(close, range(threads)))
+
+    seated = models.Player.objects.filter(ingame__isnull=False).count()
+    assert seated == count, "%d of %d players seated" % (seated, count)
+    return {"elapsed": elapsed, "times": times, "timeouts": len(timeouts)}
+
+
+# Rendering the lobby list with few and with very many lobbies, on the
+# first page and deep into the list, with and without the cached page
+def bench_lobbies(command, options):
+    renders = options["count"] or 50
+    view = GameIndexView.as_view()
+    factory = RequestFactory()
+
+    def render(query, cached):
+        request = factory.get("/palace/games", query)
+        request.user = AnonymousUser()
+        started = time.perf_counter()
+
+        for _ in range(renders):
+            if not cached:
+                cache.clear()
+
+            view(request).render()
+
+        return (time.perf_counter() - started) / renders
+
+    with scratch_database():
+        created = 0
+
+        for total in (10, 100000):
+            models.Game.objects.bulk_create(
+                [
+                    models.Game(lobby_name="bench%06d" % number, occupancy=number % 6)
+                    for number in range(created, total)
+                ],
+                batch_size=5000,
+            )
+            created = total
+            last = models.Game.objects.open().reverse().first()
+            deep = {"after": "%d.%s" % (last.occupancy, last.lobby_name)}
+
+            for label, query in (("first page", {}), ("last page", deep)):
+                command.stdout.write(
+                    "%6d lobbies, %s: %s rendered, %s cached"
+                    % (total, label, ms(render(query, False)), ms(render(query, True)))
+                )
+
+
+# CPU spent on one group broadcast when every consumer encodes its own
+# frame, against the moderator encoding it once for everyone
+def bench_broadcast(command, options):
+    rounds = options["count"] or 200
+    event = {
+        "type": "game_event",
+        "event": "new_cycle",
+        "message": "Discuss and cast votes!",
+        "theme": "light",
+    }
+
+    async def run(recipients, encode_once):
+        layer = InMemoryChannelLayer()
+        channels = [await layer.new_channel() for _ in range(recipients)]
+
+        for channel in channels:
+            await layer.group_add("bench", channel)
+
+        encoding = 0.0
+        started = time.process_time()
+
+        for _ in range(rounds):
+            before = time.process_time()
+            message = protocol.frame_message([protocol.client_frame(event)]) if encode_once else event
+            encoding += time.process_time() - before
+
+            await layer.group_send("bench", message)
+
+            for channel in channels:
+                received = await layer.receive(channel)
+                before = time.process_time()
+                text = received["text"] if encode_once else json.dumps(protocol.client_frame(received))
+                encoding += time.process_time() - before
+
+        return encoding / rounds, (time.process_time() - started) / rounds
+
+    for recipients in (6, 50, 500):
+        for encode_once in (False, True):
+            encoding, total = asyncio.run(run(recipients, encode_once))
+            command.stdout.write(
+                "%3d recipients, %-17s encoding %s, with in-memory layer %s per broadcast"
+                % (
+                    recipients,
+                    "encoded once:" if encode_once else "per recipient:",
+                    ms(encoding),
+                    ms(total),
+                )
+            )
+
+
+# WebSocket handshakes through the auth middleware, each one a session
+# and user lookup on a cold cache and none once they're cached
+def bench_handshakes(command, options):
+    count = options["count"] or 2000
+
+    with scratch_database():
+        session_keys = []
+
+        for number in range(count):
+            user = User.objects.create(username="bench%d" % number)
+            session = SessionStore()
+            session[SESSION_KEY] = str(user.pk)
+            session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+            session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+            session.create()
+            session_keys.append(session.session_key)
+
+        middleware = auth.PlayerAuthMiddleware(None)
+
+        async def handshakes():
+            async def handshake(session_key):
+                scope = {"session": SessionStore(session_key)}
+                middleware.populate_scope(scope)
+                await middleware.resolve_scope(scope)
+                return scope["user"].player.player
+
+            started = time.perf_counter()
+            names = await asyncio.gather(*map(handshake, session_keys))
+            assert len(set(names)) == count
+            return time.perf_counter() - started
+
+        auth.sessions.items.clear()
+
+        for label in ("cold cache", "warm cache"):
+            elapsed = asyncio.run(handshakes())
+            command.stdout.write(
+                "%s: %d concurrent handshakes in %s, %.0f per second"
+                % (label, count, ms(elapsed), count / elapsed)
+            )
+
+
+# Chat lines and votes through Redis and through the in-process layer
+# single-node mode uses, from several lobbies at once. A chat line is
+# one send to the lobby's group, a vote goes to the moderator first and
+# comes back to the lobby as its broadcast.
+def bench_layers(command, options):
+    count = options["count"] or 500
+    lobbies = 10
+    players = 6
+
+    async def lobby(layer, number, vote, latencies):
+        group = "palace_bench%d" % number
+        moderator = "moderator.bench%d" % number
+        channels = [await layer.new_channel() for _ in range(players)]
+
+        for channel in channels:
+            await layer.group_add(group, channel)
+
+        for line in range(count):
+            sent = time.perf_counter()
+
+            if vote:
+                await layer.send(
+                    moderator,
+                    {"type": "demand", "demand": "v", "message": "bob", "username": "ann"},
+                )
+                demand = await layer.receive(moderator)
+                frame = protocol.broadcast(
+                    demand["username"] + " voted for " + demand["message"], "success"
+                )
+            else:
+                frame = protocol.chat("line %d" % line, "ann")
+
+            await layer.group_send(group, protocol.frame_message([frame]))
+
+            for channel in channels:
+                await layer.receive(channel)
+
+            latencies.append(time.perf_counter() - sent)
+
+    async def run(config, vote):
+        options = dict(config["CONFIG"])
+
+        # Its own prefix, so flushing it afterwards leaves a live site's keys be
+        if "hosts" in options:
+            options["prefix"] = "palace-bench"
+
+        layer = import_string(config["BACKEND"])(**options)
+        latencies = []
+        started = time.perf_counter()
+
+        try:
+            await asyncio.gather(
+                *(lobby(layer, number, vote, latencies) for number in range(lobbies))
+            )
+        finally:
+            await layer.flush()
+
+        return len(latencies) / (time.perf_counter() - started), percentile(latencies, 0.99)
+
+    for label, config in (("in-process", settings.IN_PROCESS_LAYER), ("redis", settings.REDIS_LAYER)):
+        for path in ("chat", "vote"):
+            try:
+                rate, p99 = asyncio.run(run(config, path == "vote"))
+            except (ConnectionError, OSError, RedisError) as error:
+                command.stdout.write("%-10s %s: unavailable, %s" % (label, path, error))
+                break
+
+            command.stdout.write(
+                "%-10s %s: %6.0f messages per second, p99 %s"
+                % (label, path, rate, ms(p99))
+            )
+
+
+# What one broadcast to a lobby costs as the lobby grows, over the
+# in-process layer, Redis lists and Redis pub/sub. Lists write the
+# message to every member's channel, pub/sub publishes it once.
+def bench_fanout(command, options):
+    rounds = options["count"] or 200
+    layers = (
+        ("in-process", settings.IN_PROCESS_LAYER),
+        ("redis lists", settings.REDIS_LAYER),
+        ("redis pub/sub", settings.REDIS_PUBSUB_LAYER),
+    )
+    message = protocol.frame_message([protocol.chat("Hello everyone", "ann")])
+
+    async def run(config, members):
+        layer = make_layer(config)
+        channels = [await layer.new_channel() for _ in range(members)]
+
+        try:
+            for channel in channels:
+                await layer.group_add("palace_fanout", channel)
+
+            started = time.perf_counter()
+
+            for _ in range(rounds):
+                await layer.group_send("palace_fanout", message)
+
+                for channel in channels:
+                    await layer.receive(channel)
+
+            return (time.perf_counter() - started) / rounds
+        finally:
+            for channel in channels:
+                await layer.group_discard("palace_fanout", channel)
+
+    for label, config in layers:
+        for members in (6, 50, 500):
+            try:
+                elapsed = asyncio.run(run(config, members))
+            except (ConnectionError, OSError, RedisError) as error:
+                command.stdout.write("%-13s unavailable, %s" % (label, error))
+                break
+
+            command.stdout.write(
+                "%-13s %3d members: %s per broadcast, %s per member"
+                % (label, members, ms(elapsed), ms(elapsed / members))
+            )
+
+
+BENCHMARKS = {
+    "broadcast": bench_broadcast,
+    "databases": bench_databases,
+    "disconnects": bench_disconnects,
+    "fanout": bench_fanout,
+    "handshakes": bench_handshakes,
+    "joins": bench_joins,
+    "layers": bench_layers,
+    "lobbies": bench_lobbies,
+    "messages": bench_messages,
+    "snapshots": bench_snapshots,
+    "timers": bench_timers,
+}
+
+
+class Command(BaseCommand):
+    help = "Runs one of the moderator's micro-benchmarks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+        parser.add_argument("--count", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options["benchmark"] not in BENCHMARKS:
+            raise CommandError("Unknown benchmark %s" % options["benchmark"])
+
+        BENCHMARKS[options["benchmark"]](self, options)
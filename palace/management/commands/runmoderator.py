@@ -0,0 +1,37 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from palace.sharding import moderator_channels
+
+
+class Command(BaseCommand):
+    help = "Runs a worker for some or all of the moderator shards"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "shards",
+            nargs="*",
+            type=int,
+            help="Shard numbers to run, all of them when left out",
+        )
+
+    def handle(self, *args, **options):
+        channels = moderator_channels()
+        shards = options["shards"] or range(settings.MODERATOR_SHARDS)
+
+        for shard in shards:
+            if not 0 <= shard < settings.MODERATOR_SHARDS:
+                raise CommandError(
+                    "There are only %d moderator shards" % settings.MODERATOR_SHARDS
+                )
+
+        channels = [channels[shard] for shard in shards]
+
+        # Wake each shard up so it resumes its saved games right away
+        for channel in channels:
+            async_to_sync(get_channel_layer().send)(channel, {"type": "restore"})
+
+        call_command("runworker", *channels)
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('palace', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='game_message',
+            name='game',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='palace.game'),
+        ),
+        migrations.AlterField(
+            model_name='game_message',
+            name='private_recipient',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='received', to='palace.player'),
+        ),
+        migrations.AlterField(
+            model_name='game_message',
+            name='sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='sent', to='palace.player'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:52
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+# Lobbies that are already open start out with their seated players counted
+def count_players(apps, schema_editor):
+    Game = apps.get_model("palace", "Game")
+    Player = apps.get_model("palace", "Player")
+
+    Game.objects.update(
+        occupancy=Coalesce(
+            models.Subquery(
+                Player.objects.filter(ingame=models.OuterRef("pk"))
+                .values("ingame")
+                .annotate(count=models.Count("pk"))
+                .values("count")[:1]
+            ),
+            0,
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('palace', '0002_game_message_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='occupancy',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['occupancy', 'capacity'], name='game_occupancy'),
+        ),
+        migrations.RunPython(count_players, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('palace', '0003_game_occupancy'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='game',
+            name='game_occupancy',
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='in_progress',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(condition=models.Q(('in_progress', False)), fields=['-occupancy', 'lobby_name'], name='game_open'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(condition=models.Q(('in_progress', True)), fields=['-occupancy', 'lobby_name'], name='game_playing'),
+        ),
+    ]
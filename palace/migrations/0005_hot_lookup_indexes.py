@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('palace', '0004_game_in_progress'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='player',
+            name='player',
+            field=models.CharField(default='', max_length=16, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='game_message',
+            index=models.Index(fields=['game', 'timestamp', 'id'], name='message_game_time'),
+        ),
+    ]
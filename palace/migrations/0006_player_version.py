@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:01
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('palace', '0005_hot_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='updated',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
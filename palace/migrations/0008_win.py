@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('palace', '0007_lobby_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Win',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lobby_name', models.SlugField()),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('player', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='won', to='palace.player')),
+            ],
+        ),
+    ]
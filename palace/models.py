@@ -1,5 +1,6 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 
 CHAT_ZONES = (
     ("game", "GAME"),
@@ -27,9 +28,15 @@ class Player(models.Model):
         null=True,
     )
     
-    player = models.CharField(max_length=16, default="")
+    # The name players are looked up by, in URLs and by the moderator
+    player = models.CharField(max_length=16, default="", unique=True)
     wins = models.IntegerField()
 
+    # Bumped together whenever the profile changes, which is when a
+    # game they played ends. Profile pages are cached against these.
+    version = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(default=timezone.now)
+
     def __str__(self):
         return self.user.username
 
@@ -37,27 +44,105 @@ class Player(models.Model):
         return self.user.username
 
 
+# Lobbies are listed fullest first so players fill games up instead
+# of spreading out over empty ones. The lobby name breaks ties, so
+# (occupancy, lobby_name) marks a place in the list to page from.
+class GameQuerySet(models.QuerySet):
+    def listed(self):
+        return self.order_by("-occupancy", "lobby_name")
+
+    # Lobbies with a free seat, waiting for their game to start
+    def open(self):
+        return self.filter(
+            in_progress=False, occupancy__lt=models.F("capacity")
+        ).listed()
+
+    def playing(self):
+        return self.filter(in_progress=True).listed()
+
+
+# Cached lobby lists are kept under the current generation, which
+# goes up whenever a player joins or leaves or a lobby opens, starts
+# or closes. Old generations are never read again and expire.
+# The generation is one row in the database, not in a cache, so the
+# web processes see every change the moderators make too.
+class LobbyGeneration(models.Model):
+    value = models.PositiveBigIntegerField(default=0)
+
+
+def lobby_generation():
+    return LobbyGeneration.objects.filter(pk=1).values_list("value", flat=True).first() or 0
+
+
+def lobbies_changed():
+    if not LobbyGeneration.objects.filter(pk=1).update(value=models.F("value") + 1):
+        LobbyGeneration.objects.get_or_create(pk=1, defaults={"value": 1})
+
+
 # The game model
 class Game(models.Model):
     name = models.TextField()
     capacity = models.SmallIntegerField(default=6)
 
+    # How many players hold a seat. Only ever changed with F() updates
+    # as they join and leave, so it's never counted from the players
+    occupancy = models.PositiveSmallIntegerField(default=0)
+
+    # Set by the moderator once roles have been handed out
+    in_progress = models.BooleanField(default=False)
+
     winners = models.ManyToManyField(Player, related_name="winners")
 
     # The name that will appear in the address bar
     lobby_name = models.SlugField(unique=True)
 
+    objects = GameQuerySet.as_manager()
+
+    class Meta:
+        # One index per list, each already in the order it is shown
+        indexes = [
+            models.Index(
+                fields=["-occupancy", "lobby_name"],
+                condition=models.Q(in_progress=False),
+                name="game_open",
+            ),
+            models.Index(
+                fields=["-occupancy", "lobby_name"],
+                condition=models.Q(in_progress=True),
+                name="game_playing",
+            ),
+        ]
+
 
+# One row for each player on the winning side of a game. The Game row
+# is deleted once its lobby closes, these aren't tied to it so what a
+# player has won outlives the lobby they won it in.
+class Win(models.Model):
+    player = models.ForeignKey(Player, on_delete=models.CASCADE, related_name="won")
+    lobby_name = models.SlugField()
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+
+# A chat line, vote or status broadcast from a game's log.
+# Status broadcasts come from the moderator and have no sender.
 class Game_Message(models.Model):
-    game = models.ForeignKey(Game, on_delete=models.PROTECT, related_name="messages")
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name="messages")
 
-    sender = models.ForeignKey(Player, on_delete=models.PROTECT, related_name="sent")
+    sender = models.ForeignKey(
+        Player, on_delete=models.PROTECT, related_name="sent", blank=True, null=True
+    )
     chat_zone = models.CharField(max_length=16, choices=CHAT_ZONES, default="data")
     private_recipient = models.ForeignKey(
-        Player, on_delete=models.PROTECT, related_name="received", blank=True
+        Player, on_delete=models.PROTECT, related_name="received", blank=True, null=True
     )
     is_vote = models.BooleanField(null=False)
     is_status = models.BooleanField(null=False)
 
     message = models.TextField(default="")
     timestamp = models.DateTimeField(auto_now_add=True)
+
+    # A game's log is read in order, the id breaks ties in time
+    class Meta:
+        indexes = [
+            models.Index(fields=["game", "timestamp", "id"], name="message_game_time")
+        ]
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.worker import Worker
+
+from .sharding import moderator_channels
+
+logger = logging.getLogger(__name__)
+
+
+# channels' in-memory layer, except that channel_capacity works: the
+# layer keeps the patterns it's given as they are, instead of compiling
+# them like the other layers do
+class InProcessChannelLayer(InMemoryChannelLayer):
+    def __init__(self, channel_capacity=None, **kwargs):
+        super().__init__(**kwargs)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+
+
+# Single-node mode: every moderator shard runs as a task in the web
+# server's own event loop, the same as runmoderator would run them in
+# a worker of their own. Consumers and moderators share the process's
+# in-memory channel layer, so a chat line or a vote never leaves it.
+# The moderators start with the first scope the server hands over,
+# lifespan if the server sends one, otherwise the first request.
+class InProcessModerators:
+    def __init__(self, application):
+        self.application = application
+        self.worker = None
+        self.task = None
+
+    async def __call__(self, scope, receive, send):
+        if self.worker is None:
+            self.start()
+
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        return await self.application(scope, receive, send)
+
+    def start(self):
+        self.worker = Worker(self.application, moderator_channels(), get_channel_layer())
+        self.task = asyncio.ensure_future(self.run())
+        self.task.add_done_callback(self.stopped)
+
+    # Wake each shard up so it resumes its saved games right away
+    async def run(self):
+        for channel in self.worker.channels:
+            await self.worker.channel_layer.send(channel, {"type": "restore"})
+
+        await self.worker.arun()
+
+    # The moderators are gone by the time the server is told to go on
+    async def stop(self):
+        if self.task is None:
+            return None
+
+        tasks = [self.task]
+        tasks += [details["future"] for details in self.worker.application_instances.values()]
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stopped(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("In-process moderators stopped", exc_info=task.exception())
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return None
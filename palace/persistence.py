@@ -0,0 +1,311 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from functools import partial
+
+from channels.db import database_sync_to_async
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import models
+from . import leaderboard
+
+logger = logging.getLogger(__name__)
+
+
+# Collects rows in memory and writes them in the background, a batch at
+# a time, once enough have built up or the oldest has waited long enough.
+# Whoever adds a row never waits on the database.
+# One batch is written at a time so they land in the order they were
+# taken, whatever comes in meanwhile goes in the next one. A batch that
+# fails goes back to the front of the queue and is tried again.
+# How far behind it is shows in stats(): rows waiting, whether a batch
+# is being written, and how long the last and slowest batch took from
+# being handed off to being written.
+class BatchBuffer:
+    def __init__(self, max_size=200, max_delay=1.0):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.items = []
+        self.timer = None
+        self.writing = None
+        self.batches = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+
+    def add(self, item):
+        self.items.append(item)
+
+        if len(self.items) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_delay, self.flush)
+
+    # Hand everything buffered to a worker thread, unless a batch is
+    # still being written, then it follows that one
+    def flush(self):
+        if self.writing is not None:
+            return None
+
+        batch = self.take()
+
+        if batch:
+            self.writing = asyncio.ensure_future(
+                database_sync_to_async(self.write, thread_sensitive=False)(batch)
+            )
+            self.writing.add_done_callback(partial(self.written, batch, time.perf_counter()))
+
+    # Write everything buffered right now, for code that isn't async
+    def flush_now(self):
+        batch = self.take()
+
+        if batch:
+            self.write(batch)
+
+    # Wait until everything added so far has been written. A batch that
+    # fails is left queued and its error raised here.
+    async def drain(self):
+        while self.items or self.writing is not None:
+            if self.writing is None:
+                self.flush()
+
+            write = self.writing
+            await asyncio.wait([write])
+
+            if write.cancelled() or write.exception() is not None:
+                write.result()
+
+    def take(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.items = self.items, []
+        return batch
+
+    def written(self, batch, started, write):
+        self.writing = None
+        self.batches += 1
+        self.last_latency = time.perf_counter() - started
+        self.max_latency = max(self.max_latency, self.last_latency)
+
+        failed = write.cancelled() or write.exception() is not None
+
+        # Nothing in it is lost, it goes first in the next batch
+        if failed:
+            logger.error(
+                "Write-behind batch failed, %d rows queued again",
+                len(batch),
+                exc_info=None if write.cancelled() else write.exception(),
+            )
+            self.items[:0] = batch
+
+        logger.debug(
+            "%s wrote a batch in %.1f ms, %d rows queued",
+            type(self).__name__,
+            self.last_latency * 1000,
+            len(self.items),
+        )
+
+        # What came in meanwhile goes now if there's a batch of it,
+        # otherwise once it has waited
+        if len(self.items) >= self.max_size and not failed:
+            self.flush()
+        elif self.items and self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_delay, self.flush)
+
+    def stats(self):
+        return {
+            "queued": len(self.items),
+            "writing": self.writing is not None,
+            "batches": self.batches,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+        }
+
+    def write(self, batch):
+        raise NotImplementedError
+
+
+# Game_Message rows, buffered by lobby and player name. The names are
+# turned into ids with one query each per batch instead of per message.
+class MessageBuffer(BatchBuffer):
+    def write(self, batch):
+        games = dict(
+            models.Game.objects.filter(
+                lobby_name__in={lobby for lobby, *rest in batch}
+            ).values_list("lobby_name", "id")
+        )
+        senders = dict(
+            models.Player.objects.filter(
+                player__in={sender for lobby, sender, *rest in batch if sender}
+            ).values_list("player", "pk")
+        )
+
+        models.Game_Message.objects.bulk_create(
+            [
+                models.Game_Message(
+                    game_id=games[lobby],
+                    sender_id=senders.get(sender),
+                    chat_zone="game",
+                    message=message,
+                    is_vote=is_vote,
+                    is_status=is_status,
+                )
+                for lobby, sender, message, is_vote, is_status in batch
+                # The lobby may have closed before its last lines were written
+                if lobby in games
+            ]
+        )
+
+
+# The moderator's own writes: players giving up their seat or taking
+# it again, games starting and ending, and lobbies closing. Many
+# players leaving at once, say after a network blip, cost two updates
+# per lobby and one delete instead of a round trip each.
+class PlayerWriteQueue(BatchBuffer):
+    def leave(self, lobby_name, username):
+        self.add(("leave", lobby_name, username))
+
+    def join(self, lobby_name, username):
+        self.add(("join", lobby_name, username))
+
+    def start(self, lobby_name):
+        self.add(("start", lobby_name, None))
+
+    def win(self, lobby_name, usernames):
+        self.add(("win", lobby_name, tuple(usernames)))
+
+    def close(self, lobby_name):
+        self.add(("close", lobby_name, None))
+
+    def write(self, batch):
+        seats = {}
+        leaving = {}
+        joining = {}
+        starting = set()
+        winners = {}
+        closing = set()
+        wins = []
+
+        for kind, lobby_name, username in batch:
+            if kind in ("leave", "join"):
+                # Whichever a player did last in the batch is what counts
+                seats[lobby_name, username] = kind
+            elif kind == "start":
+                starting.add(lobby_name)
+            elif kind == "win":
+                winners.setdefault(lobby_name, []).extend(username)
+            else:
+                closing.add(lobby_name)
+
+        for (lobby_name, username), kind in seats.items():
+            seated = leaving if kind == "leave" else joining
+            seated.setdefault(lobby_name, set()).add(username)
+
+        with transaction.atomic():
+            for lobby_name, usernames in leaving.items():
+                # Only players still seated here give a seat back
+                left = models.Player.objects.filter(
+                    player__in=usernames, ingame__lobby_name=lobby_name
+                ).update(ingame=None)
+
+                if left:
+                    models.Game.objects.filter(lobby_name=lobby_name).update(
+                        occupancy=Greatest(F("occupancy") - left, 0)
+                    )
+
+            if joining:
+                self.write_joins(joining)
+
+            models.Game.objects.filter(lobby_name__in=starting).update(in_progress=True)
+
+            if winners:
+                wins = self.write_wins(winners)
+
+            # A lobby someone has joined again since it emptied stays open.
+            # Seats in a game that started are only given back as it closes,
+            # deleting it frees every one of them.
+            models.Game.objects.filter(
+                Q(occupancy=0) | Q(in_progress=True), lobby_name__in=closing
+            ).delete()
+
+        models.lobbies_changed()
+        leaderboard.publish(wins)
+
+    # Players the moderator has in a lobby's list whose seat was given
+    # back anyway, by a socket they had already replaced, sit again.
+    # Anyone still seated, here or elsewhere, is left as they are.
+    def write_joins(self, joining):
+        games = dict(
+            models.Game.objects.filter(lobby_name__in=joining).values_list("lobby_name", "pk")
+        )
+
+        for lobby_name, usernames in joining.items():
+            if lobby_name not in games:
+                continue
+
+            joined = models.Player.objects.filter(player__in=usernames, ingame=None).update(
+                ingame=games[lobby_name]
+            )
+
+            if joined:
+                models.Game.objects.filter(pk=games[lobby_name]).update(
+                    occupancy=F("occupancy") + joined
+                )
+
+    # Every game's winners go in with one insert into Win, which stays
+    # once the game is deleted, and every player's wins counter goes up
+    # in place with F(). Returns the winners' new counts for the web
+    # processes' leaderboards.
+    def write_wins(self, winners):
+        players = dict(
+            models.Player.objects.filter(
+                player__in={name for names in winners.values() for name in names}
+            ).values_list("player", "pk")
+        )
+
+        models.Win.objects.bulk_create(
+            [
+                models.Win(player_id=players[name], lobby_name=lobby_name)
+                for lobby_name, names in winners.items()
+                for name in names
+                if name in players
+            ]
+        )
+
+        wins = Counter(name for names in winners.values() for name in names)
+        by_count = {}
+
+        for name, count in wins.items():
+            if name in players:
+                by_count.setdefault(count, []).append(players[name])
+
+        for count, pks in by_count.items():
+            models.Player.objects.filter(pk__in=pks).update(
+                wins=F("wins") + count, version=F("version") + 1, updated=timezone.now()
+            )
+
+        return list(
+            models.Player.objects.filter(
+                pk__in=[players[name] for name in wins if name in players]
+            ).values_list("player", "wins")
+        )
+
+
+messages = MessageBuffer()
+
+
+def record_chat(lobby, sender, message):
+    messages.add((lobby, sender, message, False, False))
+
+
+def record_vote(lobby, voter, message):
+    messages.add((lobby, voter, message, True, False))
+
+
+def record_status(lobby, message):
+    messages.add((lobby, None, message, False, True))
@@ -0,0 +1,241 @@
+import json
+import struct
+
+# The frames the lobby page understands. They are built and encoded
+# once by whoever sends them, consumers just pass the text along.
+
+# WebSocket subprotocols a client can ask for. JSON text frames are
+# used when it asks for neither.
+BINARY = "palace.bin"
+JSON = "palace.json"
+
+
+def chat(message, username):
+    return {"type": "chat", "message": message, "username": username}
+
+
+def broadcast(message, theme):
+    return {"type": "broadcast", "message": message, "theme": theme}
+
+
+def event(event, message="", theme="", player="", role=""):
+    return {
+        "type": "event",
+        "event": event,
+        "message": message,
+        "theme": theme,
+        "player": player,
+        "role": role,
+    }
+
+
+# The lobby's player list. "full" carries every name, "join" and "leave"
+# the one that changed. Each change bumps the version by one, so a client
+# can tell when it has missed one and ask for the full list again.
+def roster(op, version, players):
+    return {"type": "roster", "op": op, "version": version, "players": players}
+
+
+# Lines from the lobby's log, oldest first, as [sender, message] with
+# no sender for the moderator's. "before" is the cursor to ask for the
+# page before them with, empty when there's nothing older.
+def history(lines, before):
+    return {"type": "history", "lines": lines, "before": before or ""}
+
+
+# Something the client sent was turned away. "retry" is how many
+# milliseconds to wait before sending it again.
+def error(code, retry=0):
+    return {"type": "error", "code": code, "retry": retry}
+
+
+# The moderator's game_message, game_event and roster layer messages as frames
+def client_frame(message):
+    if message["type"] == "game_message":
+        return broadcast(message["message"], message["theme"])
+    elif message["type"] == "roster":
+        return roster(message["op"], message["version"], message["players"])
+
+    return event(
+        message["event"],
+        message.get("message", ""),
+        message.get("theme", ""),
+        message.get("player", ""),
+        message.get("role", ""),
+    )
+
+
+CLIENT_FRAMES = ("game_message", "game_event", "roster")
+
+
+# Several frames are sent as one batch frame, handled in order
+def encode(frames):
+    if len(frames) == 1:
+        frame = frames[0]
+    else:
+        frame = {"type": "batch", "events": frames}
+
+    return json.dumps(frame, separators=(",", ":"))
+
+
+# The binary protocol packs each frame as a MessagePack array led by
+# a small code instead of a map of repeated keys. Frames without a code
+# are packed as plain maps.
+FRAME_CODES = {"batch": 0, "chat": 1, "broadcast": 2, "event": 3, "roster": 4, "history": 5, "error": 6}
+EVENT_CODES = {
+    name: code
+    for code, name in enumerate(
+        (
+            "users",
+            "beginning",
+            "new_cycle",
+            "role",
+            "self",
+            "out",
+            "disconnected",
+            "reconnected",
+            "called_off",
+        ),
+        1,
+    )
+}
+ROSTER_CODES = {"full": 0, "join": 1, "leave": 2}
+
+
+def compact(frame):
+    kind = frame["type"]
+
+    if kind == "batch":
+        return [FRAME_CODES["batch"], [compact(item) for item in frame["events"]]]
+    elif kind == "chat":
+        return [FRAME_CODES["chat"], frame["message"], frame["username"]]
+    elif kind == "broadcast":
+        return [FRAME_CODES["broadcast"], frame["message"], frame["theme"]]
+    elif kind == "event":
+        fields = [
+            FRAME_CODES["event"],
+            EVENT_CODES.get(frame["event"], frame["event"]),
+            frame["message"],
+            frame["theme"],
+            frame["player"],
+            frame["role"],
+        ]
+
+        # Most events leave the later fields empty
+        while fields[-1] == "":
+            fields.pop()
+
+        return fields
+    elif kind == "roster":
+        return [
+            FRAME_CODES["roster"],
+            ROSTER_CODES[frame["op"]],
+            frame["version"],
+            frame["players"],
+        ]
+    elif kind == "history":
+        return [FRAME_CODES["history"], frame["lines"], frame["before"]]
+    elif kind == "error":
+        return [FRAME_CODES["error"], frame["code"], frame["retry"]]
+
+    return frame
+
+
+# The part of MessagePack the frames need
+def pack(value, out=None):
+    if out is None:
+        out = bytearray()
+        pack(value, out)
+        return bytes(out)
+
+    if value is None:
+        out.append(0xC0)
+    elif value is True:
+        out.append(0xC3)
+    elif value is False:
+        out.append(0xC2)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif -0x20 <= value < 0:
+            out.append(value & 0xFF)
+        elif 0 <= value <= 0xFFFFFFFF:
+            out += struct.pack(">BI", 0xCE, value)
+        else:
+            out += struct.pack(">Bq", 0xD3, value)
+    elif isinstance(value, str):
+        data = value.encode()
+        size = len(data)
+
+        if size < 32:
+            out.append(0xA0 | size)
+        elif size < 0x100:
+            out += struct.pack(">BB", 0xD9, size)
+        elif size < 0x10000:
+            out += struct.pack(">BH", 0xDA, size)
+        else:
+            out += struct.pack(">BI", 0xDB, size)
+
+        out += data
+    elif isinstance(value, (list, tuple)):
+        pack_array_header(len(value), out)
+
+        for item in value:
+            pack(item, out)
+    elif isinstance(value, dict):
+        if len(value) < 16:
+            out.append(0x80 | len(value))
+        else:
+            out += struct.pack(">BI", 0xDF, len(value))
+
+        for key, item in value.items():
+            pack(key, out)
+            pack(item, out)
+    else:
+        raise TypeError("Can't pack %r" % type(value))
+
+
+def pack_array_header(size, out):
+    if size < 16:
+        out.append(0x90 | size)
+    else:
+        out += struct.pack(">BI", 0xDD, size)
+
+
+def encode_binary(frames):
+    if len(frames) == 1:
+        frame = frames[0]
+    else:
+        frame = {"type": "batch", "events": frames}
+
+    return pack(compact(frame))
+
+
+# A channel layer message carrying frames that are already encoded,
+# in both protocols since the sender doesn't know who will get it.
+# Messages that are only chat are marked, when a socket falls behind
+# they are the first to go.
+def frame_message(frames):
+    return {
+        "type": "frame",
+        "text": encode(frames),
+        "bytes": encode_binary(frames),
+        "chat": all(frame["type"] == "chat" for frame in frames),
+    }
+
+
+# Several frame messages as one batch, put together from their encoded
+# text and bytes without decoding anything. Batches can hold batches.
+def join_frame_messages(messages):
+    data = bytearray([0x92, FRAME_CODES["batch"]])
+    pack_array_header(len(messages), data)
+
+    for message in messages:
+        data += message["bytes"]
+
+    return {
+        "type": "frame",
+        "text": '{"type":"batch","events":[%s]}' % ",".join(message["text"] for message in messages),
+        "bytes": bytes(data),
+        "chat": all(message["chat"] for message in messages),
+    }
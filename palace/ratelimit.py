@@ -0,0 +1,76 @@
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+# Holds up to burst tokens and gains rate of them a second. Tokens are
+# only worked out when the bucket is looked at, nothing runs in between.
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated", "clock")
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    # Seconds until there's a whole token again
+    def wait(self):
+        return max(0.0, (1 - self.refill()) / self.rate)
+
+
+# What a socket may send, by kind: chat lines, and commands for the
+# moderator or the socket itself. Each socket has a bucket per kind and
+# every socket of a user in this process shares one more, so opening
+# more tabs doesn't buy more messages. It's all counted in memory,
+# checking costs no network calls. Users' buckets are kept for the
+# most recent max_users, a bucket that was dropped would have filled
+# up again by now anyway.
+class RateLimits:
+    def __init__(self, budgets, max_users=10000, clock=time.monotonic):
+        self.budgets = budgets
+        self.max_users = max_users
+        self.clock = clock
+        self.users = OrderedDict()
+
+    def buckets(self, scope):
+        return {
+            kind: TokenBucket(*budget[scope], clock=self.clock)
+            for kind, budget in self.budgets.items()
+        }
+
+    def connection(self):
+        return self.buckets("connection")
+
+    def user(self, username):
+        buckets = self.users.pop(username, None) or self.buckets("user")
+        self.users[username] = buckets
+
+        while len(self.users) > self.max_users:
+            self.users.popitem(last=False)
+
+        return buckets
+
+    # A message costs a token from the socket's bucket and the user's,
+    # it only goes through if both have one. Returns how long to wait
+    # before trying again, 0 once it has gone through.
+    def take(self, connection, username, kind):
+        buckets = (connection[kind], self.user(username)[kind])
+        wait = max(bucket.wait() for bucket in buckets)
+
+        if wait == 0:
+            for bucket in buckets:
+                bucket.tokens -= 1
+
+        return wait
+
+
+limits = RateLimits(settings.PLAYER_RATE_LIMITS)
@@ -0,0 +1,45 @@
+import bisect
+import hashlib
+from functools import lru_cache
+
+from django.conf import settings
+
+
+def point(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+# A consistent-hash ring. Every shard owns many small arcs of it, and a
+# lobby belongs to the shard owning the arc its name hashes into. Adding
+# a shard only takes over some arcs, so most lobbies stay where they are.
+class HashRing:
+    def __init__(self, shards, replicas=128):
+        ring = sorted(
+            (point("%s#%d" % (shard, replica)), shard)
+            for shard in shards
+            for replica in range(replicas)
+        )
+        self.points = [position for position, shard in ring]
+        self.shards = [shard for position, shard in ring]
+
+    def get(self, key):
+        index = bisect.bisect(self.points, point(key)) % len(self.points)
+        return self.shards[index]
+
+
+# The channel names the moderator shards listen on
+def moderator_channels(shards=None):
+    if shards is None:
+        shards = settings.MODERATOR_SHARDS
+
+    return ["moderator.%d" % shard for shard in range(shards)]
+
+
+@lru_cache(maxsize=None)
+def ring(shards):
+    return HashRing(moderator_channels(shards))
+
+
+# Which moderator runs a lobby's game
+def moderator_for(lobby_name):
+    return ring(settings.MODERATOR_SHARDS).get(lobby_name)
@@ -1,12 +1,38 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
 from django.dispatch import receiver
 from django.db.models.signals import post_save, post_init
-from django.contrib.auth.signals import user_logged_in
+from django.contrib.auth.signals import user_logged_in, user_logged_out
 from django.contrib.auth.models import User
 
+from . import auth
 from .models import Player
 
 @receiver(post_save, sender=User)
 def create_player(sender, instance, created, **kwargs):
     if created:
         Player.objects.create(user=instance, player=instance.username, wins=0)
-        instance.player.save()
\ No newline at end of file
+        instance.player.save()
+
+
+# Sockets opened with a session that has logged out, or with a
+# password that has since changed, must not be let in from the cache
+@receiver(user_logged_out)
+def forget_session(sender, request, user, **kwargs):
+    if request.session.session_key is not None:
+        auth.forget_session(request.session.session_key)
+
+
+@receiver(post_save, sender=User)
+def forget_user_sessions(sender, instance, created, update_fields=None, **kwargs):
+    if not created and (update_fields is None or "password" in update_fields):
+        auth.forget_user(instance.pk)
+
+
+# The settings' SQLite pragmas only last as long as the connection
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            for pragma in settings.SQLITE_PRAGMAS:
+                cursor.execute("PRAGMA %s" % pragma)
@@ -0,0 +1,157 @@
+import json
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshot (
+    shard TEXT NOT NULL,
+    lobby TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (shard, lobby)
+);
+CREATE TABLE IF NOT EXISTS delta (
+    seq INTEGER PRIMARY KEY,
+    shard TEXT NOT NULL,
+    lobby TEXT NOT NULL,
+    patch TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS delta_lobby ON delta (shard, lobby);
+"""
+
+
+def encode(value):
+    return json.dumps(value, separators=(",", ":"))
+
+
+# What changed between two game states. Players are compared one by one,
+# a player who left is recorded as None.
+def diff(old, new):
+    patch = {
+        key: value
+        for key, value in new.items()
+        if key != "players" and old.get(key) != value
+    }
+    players = {
+        name: player
+        for name, player in new["players"].items()
+        if old["players"].get(name) != player
+    }
+
+    for name in old["players"]:
+        if name not in new["players"]:
+            players[name] = None
+
+    if players:
+        patch["players"] = players
+
+    return patch
+
+
+# Patch a state in place
+def apply(state, patch):
+    players = patch.pop("players", None)
+    state.update(patch)
+
+    if players:
+        for name, player in players.items():
+            if player is None:
+                state["players"].pop(name, None)
+            else:
+                state["players"][name] = player
+
+
+# Keeps a moderator shard's games on disk, so a restarted worker can
+# pick them up where they were. Each lobby has a full snapshot and an
+# append-only log of small patches on top of it. Once a lobby has
+# logged enough patches a fresh snapshot replaces them.
+# Records are queued and written in one transaction by flush(), or
+# taken on the moderator's loop and written by write() on a thread, one
+# batch at a time.
+class SnapshotStore:
+    def __init__(self, path, shard, compact_every=32):
+        self.shard = shard
+        self.compact_every = compact_every
+        self.last = {}
+        self.deltas = {}
+        self.pending = []
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    # Record a lobby's latest state, None once its game has closed
+    def track(self, lobby, state):
+        old = self.last.get(lobby)
+
+        if state is None:
+            if lobby in self.last:
+                del self.last[lobby]
+                del self.deltas[lobby]
+                self.pending.append(("drop", lobby, None))
+
+        elif old is None or self.deltas[lobby] >= self.compact_every:
+            self.last[lobby] = state
+            self.deltas[lobby] = 0
+            self.pending.append(("snapshot", lobby, state))
+
+        else:
+            patch = diff(old, state)
+
+            if patch:
+                self.last[lobby] = state
+                self.deltas[lobby] += 1
+                self.pending.append(("delta", lobby, patch))
+
+    def flush(self):
+        self.write(self.take())
+
+    def take(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+    def write(self, pending):
+        with self.db:
+            for kind, lobby, value in pending:
+                if kind == "delta":
+                    self.db.execute(
+                        "INSERT INTO delta (shard, lobby, patch) VALUES (?, ?, ?)",
+                        (self.shard, lobby, encode(value)),
+                    )
+                    continue
+
+                self.db.execute(
+                    "DELETE FROM delta WHERE shard = ? AND lobby = ?", (self.shard, lobby)
+                )
+
+                if kind == "snapshot":
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO snapshot (shard, lobby, state)"
+                        " VALUES (?, ?, ?)",
+                        (self.shard, lobby, encode(value)),
+                    )
+                else:
+                    self.db.execute(
+                        "DELETE FROM snapshot WHERE shard = ? AND lobby = ?",
+                        (self.shard, lobby),
+                    )
+
+    # Rebuild every lobby's state: its snapshot, then its patches in order
+    def load(self):
+        states = {
+            lobby: json.loads(state)
+            for lobby, state in self.db.execute(
+                "SELECT lobby, state FROM snapshot WHERE shard = ?", (self.shard,)
+            )
+        }
+        deltas = dict.fromkeys(states, 0)
+
+        for lobby, patch in self.db.execute(
+            "SELECT lobby, patch FROM delta WHERE shard = ? ORDER BY seq", (self.shard,)
+        ):
+            if lobby in states:
+                apply(states[lobby], json.loads(patch))
+                deltas[lobby] += 1
+
+        self.last = dict(states)
+        self.deltas = deltas
+        return states
@@ -0,0 +1,122 @@
+/*
+Decoder for the binary lobby protocol (palace.bin), see palace/protocol.py.
+Frames are MessagePack arrays led by a small code, they are turned back
+into the same objects the JSON protocol sends.
+*/
+
+(function () {
+
+	const FRAMES = ["batch", "chat", "broadcast", "event", "roster", "history", "error"];
+	const EVENTS = [null, "users", "beginning", "new_cycle", "role", "self", "out", "disconnected", "reconnected", "called_off"];
+	const ROSTER = ["full", "join", "leave"];
+	const text = new TextDecoder();
+
+	function Reader(buffer) {
+		this.view = new DataView(buffer);
+		this.bytes = new Uint8Array(buffer);
+		this.pos = 0;
+	}
+
+	Reader.prototype.take = function (size) {
+		var start = this.pos;
+		this.pos += size;
+		return start;
+	};
+
+	Reader.prototype.string = function (size) {
+		var start = this.take(size);
+		return text.decode(this.bytes.subarray(start, start + size));
+	};
+
+	Reader.prototype.array = function (size) {
+		var items = [];
+		for (var i = 0; i < size; i++) {
+			items.push(this.read());
+		}
+		return items;
+	};
+
+	Reader.prototype.map = function (size) {
+		var items = {};
+		for (var i = 0; i < size; i++) {
+			var key = this.read();
+			items[key] = this.read();
+		}
+		return items;
+	};
+
+	Reader.prototype.read = function () {
+		var view = this.view;
+		var b = view.getUint8(this.take(1));
+
+		if (b < 0x80) return b;
+		if (b >= 0xe0) return b - 0x100;
+		if ((b & 0xf0) === 0x80) return this.map(b & 0x0f);
+		if ((b & 0xf0) === 0x90) return this.array(b & 0x0f);
+		if ((b & 0xe0) === 0xa0) return this.string(b & 0x1f);
+
+		switch (b) {
+			case 0xc0: return null;
+			case 0xc2: return false;
+			case 0xc3: return true;
+			case 0xcc: return view.getUint8(this.take(1));
+			case 0xcd: return view.getUint16(this.take(2));
+			case 0xce: return view.getUint32(this.take(4));
+			case 0xcf: return Number(view.getBigUint64(this.take(8)));
+			case 0xd0: return view.getInt8(this.take(1));
+			case 0xd1: return view.getInt16(this.take(2));
+			case 0xd2: return view.getInt32(this.take(4));
+			case 0xd3: return Number(view.getBigInt64(this.take(8)));
+			case 0xd9: return this.string(view.getUint8(this.take(1)));
+			case 0xda: return this.string(view.getUint16(this.take(2)));
+			case 0xdb: return this.string(view.getUint32(this.take(4)));
+			case 0xdc: return this.array(view.getUint16(this.take(2)));
+			case 0xdd: return this.array(view.getUint32(this.take(4)));
+			case 0xde: return this.map(view.getUint16(this.take(2)));
+			case 0xdf: return this.map(view.getUint32(this.take(4)));
+		}
+
+		throw new Error("Unknown MessagePack byte " + b);
+	}
+
+	// Turn a compact frame back into the object the JSON protocol sends
+	function expand(item) {
+		if (!Array.isArray(item)) {
+			return item;
+		}
+
+		var kind = FRAMES[item[0]];
+
+		if (kind === "batch") {
+			return { type: "batch", events: item[1].map(expand) };
+		}
+		if (kind === "chat") {
+			return { type: "chat", message: item[1], username: item[2] };
+		}
+		if (kind === "broadcast") {
+			return { type: "broadcast", message: item[1], theme: item[2] };
+		}
+		if (kind === "history") {
+			return { type: "history", lines: item[1], before: item[2] };
+		}
+		if (kind === "error") {
+			return { type: "error", code: item[1], retry: item[2] };
+		}
+		if (kind === "roster") {
+			return { type: "roster", op: ROSTER[item[1]], version: item[2], players: item[3] };
+		}
+		return {
+			type: "event",
+			event: typeof item[1] === "number" ? EVENTS[item[1]] : item[1],
+			message: item[2] || "",
+			theme: item[3] || "",
+			player: item[4] || "",
+			role: item[5] || "",
+		};
+	}
+
+	window.palaceDecode = function (buffer) {
+		return expand(new Reader(buffer).read());
+	};
+
+})();
@@ -1,11 +1,48 @@
 # mafia/tests.py
-from channels.testing import ChannelsLiveServerTestCase
+import asyncio
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, URLRouter
+from channels.testing import ChannelsLiveServerTestCase, WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.db import DatabaseError, connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
 from selenium import webdriver
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.wait import WebDriverWait
 
+from . import auth, models, protocol, routing
+from .auth import PlayerAuthMiddleware, TTLCache
+from .history import History
+from .layers import InstrumentedChannelLayer, make_layer
+from .leaderboard import FollowWins, Leaderboard, leaderboard
+from .ratelimit import RateLimits, TokenBucket
+from .node import InProcessChannelLayer, InProcessModerators
+from .consumers import GameConsumer, LobbyConsumer
+from .game import ROLES
+from .persistence import MessageBuffer, PlayerWriteQueue, messages
+from .sharding import HashRing, moderator_channels, moderator_for
+from .snapshots import SnapshotStore
+from .timers import Scheduler, TimingWheel
+
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
 
 class ChatTests(ChannelsLiveServerTestCase):
     serve_static = True  # emulate StaticLiveServerTestCase
@@ -103,4 +140,1667 @@ class ChatTests(ChannelsLiveServerTestCase):
     def _chat_log_value(self):
         return self.driver.find_element(
             by=By.CSS_SELECTOR, value="#chat-log"
-        ).get_property("value")
\ No newline at end of file
+        ).get_property("value")
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class GameRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(messages.take)
+        self.moderator = GameConsumer()
+        self.moderator.channel_layer = get_channel_layer()
+
+        # There's no database here, seat writes are left queued
+        self.moderator.player_writes.max_size = float("inf")
+        self.addCleanup(self.moderator.player_writes.take)
+
+    async def test_one_moderator_runs_many_lobbies_apart(self):
+        for lobby in range(1000):
+            for seat in range(3):
+                await self.moderator.connect(
+                    {
+                        "type": "connect",
+                        "id": "lobby%d" % lobby,
+                        "username": "p%d_%d" % (lobby, seat),
+                        "player_channel": "specific.p%d_%d" % (lobby, seat),
+                    }
+                )
+
+        self.assertEqual(len(self.moderator.games), 1000)
+
+        for lobby in range(1000):
+            game = self.moderator.games.get("lobby%d" % lobby)
+            self.assertEqual(game.player_count, 3)
+            self.assertEqual(
+                sorted(game.players), ["p%d_%d" % (lobby, seat) for seat in range(3)]
+            )
+            self.assertTrue(game.lobby)
+
+    async def test_demand_for_unknown_lobby_is_ignored(self):
+        await self.moderator.demand(
+            {"type": "demand", "id": "nowhere", "demand": "c", "message": "x", "username": "y"}
+        )
+        self.assertEqual(len(self.moderator.games), 0)
+
+    async def test_bad_demands_leave_every_lobby_running(self):
+        self.moderator.resumed = True
+
+        for lobby in ("one", "two"):
+            await self.moderator.dispatch(
+                {"type": "connect", "id": lobby, "username": lobby, "player_channel": "specific." + lobby}
+            )
+        self.moderator.games.get("one").lobby = False
+
+        for demand in ("c", "j"):
+            await self.moderator.dispatch(
+                {"type": "demand", "id": "one", "demand": demand, "message": "nobody", "username": "one"}
+            )
+        await self.moderator.dispatch(
+            {"type": "init.game", "id": "one", "player": "nobody", "player_channel": "specific.x"}
+        )
+        self.assertEqual(self.moderator.games.get("one").votes, 0)
+
+        # Whatever else goes wrong in one lobby is logged, not raised
+        with mock.patch.object(self.moderator, "vote", side_effect=RuntimeError):
+            with self.assertLogs("palace.consumers", "ERROR"):
+                await self.moderator.dispatch(
+                    {"type": "demand", "id": "one", "demand": "c", "message": "one", "username": "one"}
+                )
+
+        self.assertEqual(sorted(self.moderator.games.games), ["one", "two"])
+
+    async def test_only_the_beast_jumps_once_the_game_is_on(self):
+        self.moderator.resumed = True
+        game = self.moderator.games.open("jump")
+
+        for name, role in (("king", "King"), ("guard", "Guard"), ("beast", "Beast"), ("watcher", "")):
+            await self.moderator.dispatch(
+                {"type": "connect", "id": "jump", "username": name, "player_channel": "specific." + name}
+            )
+            game.players[name].role = role
+        game.players["watcher"].spectator = True
+
+        async def jump(jumper):
+            await self.moderator.dispatch(
+                {"type": "demand", "id": "jump", "demand": "j", "message": "beast", "username": jumper}
+            )
+
+        # Nobody jumps in the lobby, not even the Beast
+        await jump("beast")
+        game.lobby = False
+
+        for jumper in ("guard", "king", "watcher", "stranger"):
+            await jump(jumper)
+
+        self.assertFalse(game.game_over)
+        self.assertFalse([item for item in self.moderator.player_writes.items if item[0] == "win"])
+
+        await jump("beast")
+        self.assertTrue(game.game_over)
+        self.assertIn(("win", "jump", ("king", "guard")), self.moderator.player_writes.items)
+
+    async def test_full_lobby_counts_down_without_blocking(self):
+        for seat in range(6):
+            await self.moderator.connect(
+                {
+                    "type": "connect",
+                    "id": "full",
+                    "username": "f%d" % seat,
+                    "player_channel": "specific.f%d" % seat,
+                }
+            )
+
+        # The countdown is pending, yet the next lobby is served straight away
+        started = time.monotonic()
+        await self.moderator.connect(
+            {
+                "type": "connect",
+                "id": "other",
+                "username": "o0",
+                "player_channel": "specific.o0",
+            }
+        )
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertTrue(self.moderator.games.get("full").lobby)
+        self.assertIn("other", self.moderator.games)
+
+    async def test_countdown_stops_when_a_seat_comes_free(self):
+        game = self.moderator.games.open("count")
+
+        async def event(kind, name):
+            await self.moderator.dispatch(
+                {"type": kind, "id": "count", "username": name, "player_channel": "specific." + name}
+            )
+
+        def pending():
+            return [phase for phase, timer in game.timers if timer.pending]
+
+        self.moderator.resumed = True
+        for seat in range(6):
+            await event("connect", "c%d" % seat)
+        self.assertEqual(pending(), ["begin"])
+
+        # Leaving and coming back makes one countdown, not two
+        await event("disconnect", "c0")
+        self.assertEqual(pending(), [])
+        await event("connect", "c0")
+        self.assertEqual(pending(), ["begin"])
+
+        # Late arrivals watch
+        await event("connect", "late")
+        self.assertTrue(game.players["late"].spectator)
+        self.assertEqual(game.player_count, 6)
+
+        # A phase already under way checks the seats again
+        game.countdown.cancel()
+        await self.moderator.begin(game)
+        self.assertEqual(pending(), ["assign_roles"])
+        await event("disconnect", "c1")
+        self.assertEqual(pending(), [])
+        await self.moderator.assign_roles(game)
+        self.assertTrue(game.lobby)
+
+        # Everyone's tabs ask for a role, the seated players get one each
+        await event("connect", "c1")
+        game.countdown.cancel()
+        await self.moderator.assign_roles(game)
+        self.assertFalse(game.lobby)
+
+        for name in list(game.players) * 2:
+            await self.moderator.dispatch(
+                {"type": "init.game", "id": "count", "player": name, "player_channel": "specific." + name}
+            )
+
+        self.assertEqual(game.roles, [])
+        self.assertEqual(game.players["late"].role, "")
+        self.assertEqual(
+            sorted(player.role for player in game.players.values() if not player.spectator),
+            sorted(ROLES),
+        )
+        self.assertEqual(pending(), ["cycle"])
+        game.cancel_timers()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TimingWheelTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = TimingWheel(tick=0.01, clock=self.clock)
+        self.fired = []
+
+    def fast_forward(self, seconds, step=None):
+        end = self.clock.now + seconds
+        step = step or seconds
+
+        while self.clock.now < end:
+            self.clock.now = min(end, self.clock.now + step)
+            self.wheel.advance()
+
+    def test_deadline_fires_once_its_time_has_passed(self):
+        self.wheel.schedule(5, self.fired.append, "tally")
+
+        self.fast_forward(4.99)
+        self.assertEqual(self.fired, [])
+        self.fast_forward(0.01)
+        self.assertEqual(self.fired, ["tally"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancelled_deadline_never_fires(self):
+        timer = self.wheel.schedule(50, self.fired.append, "cycle")
+        self.wheel.schedule(50, self.fired.append, "other")
+
+        timer.cancel()
+        timer.cancel()
+        self.assertEqual(len(self.wheel), 1)
+
+        self.fast_forward(60, step=0.5)
+        self.assertEqual(self.fired, ["other"])
+
+    def test_far_deadlines_cascade_down_to_their_tick(self):
+        # Spread over every level of the wheel
+        for delay in (0.01, 0.63, 0.64, 50, 40.96, 3600, 86400):
+            self.wheel.schedule(delay, self.fired.append, delay)
+
+        self.fast_forward(86400, step=0.01 * 97)
+        self.assertEqual(self.fired, [0.01, 0.63, 0.64, 40.96, 50, 3600, 86400])
+
+    def test_fifty_thousand_pending_deadlines_fire_on_their_tick(self):
+        rng = random.Random(3)
+        late = []
+
+        def check(deadline):
+            late.append(self.clock.now - deadline)
+
+        for _ in range(50000):
+            delay = rng.uniform(0, 60)
+            self.wheel.schedule(delay, check, self.clock.now + delay)
+
+        self.assertEqual(len(self.wheel), 50000)
+        self.fast_forward(61, step=0.01)
+
+        self.assertEqual(len(late), 50000)
+        self.assertGreaterEqual(min(late), -1e-6)
+        self.assertLess(max(late), 0.02 + 1e-6)
+
+
+class SchedulerTests(SimpleTestCase):
+    async def test_a_nearer_deadline_is_not_kept_waiting(self):
+        scheduler = Scheduler()
+        fired = []
+
+        async def phase(name):
+            fired.append((name, time.monotonic()))
+
+        # A lobby's cycle is pending, the ticker sleeps until it's near
+        cycle = scheduler.call_later(1, phase, "cycle")
+        await asyncio.sleep(0.02)
+
+        started = time.monotonic()
+        scheduler.call_later(0.01, phase, "countdown")
+        await asyncio.sleep(0.1)
+
+        self.assertEqual([name for name, at in fired], ["countdown"])
+        self.assertLess(fired[0][1] - started, 0.05)
+        cycle.cancel()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class GamePhaseTests(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(messages.take)
+
+    async def test_game_over_cancels_pending_phases(self):
+        moderator = GameConsumer()
+        moderator.channel_layer = get_channel_layer()
+        game = moderator.games.open("jumped")
+
+        for name, role in (("king", "King"), ("beast", "Beast")):
+            await moderator.connect(
+                {"type": "connect", "id": "jumped", "username": name, "player_channel": "specific." + name}
+            )
+            game.players[name].role = role
+
+        game.lobby = False
+        await moderator.cycle(game)
+        self.assertEqual(len(moderator.scheduler.wheel), 1)
+
+        await moderator.demand(
+            {"type": "demand", "id": "jumped", "demand": "j", "message": "king", "username": "beast"}
+        )
+        self.assertTrue(game.game_over)
+        self.assertEqual(len(moderator.scheduler.wheel), 0)
+
+
+class ShardingTests(SimpleTestCase):
+    lobbies = ["lobby%d" % number for number in range(10000)]
+
+    def test_lobbies_spread_over_every_shard(self):
+        ring = HashRing(moderator_channels(8))
+        counts = {}
+
+        for lobby in self.lobbies:
+            shard = ring.get(lobby)
+            counts[shard] = counts.get(shard, 0) + 1
+
+        self.assertEqual(sorted(counts), moderator_channels(8))
+        self.assertLess(max(counts.values()), 2 * min(counts.values()))
+
+    def test_adding_a_shard_moves_only_a_fraction_of_lobbies(self):
+        before = HashRing(moderator_channels(4))
+        after = HashRing(moderator_channels(5))
+
+        moved = [lobby for lobby in self.lobbies if before.get(lobby) != after.get(lobby)]
+
+        # Roughly a fifth should move, and only onto the new shard
+        self.assertLess(len(moved), len(self.lobbies) * 0.3)
+        self.assertEqual({after.get(lobby) for lobby in moved}, {"moderator.4"})
+
+    def test_consumer_and_launcher_share_the_mapping(self):
+        with self.settings(MODERATOR_SHARDS=3):
+            self.assertIn(moderator_for("abc"), moderator_channels())
+            self.assertEqual(moderator_for("abc"), HashRing(moderator_channels(3)).get("abc"))
+
+
+class SnapshotStoreTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "snapshots.sqlite3")
+
+    def state(self, votes, players):
+        return {
+            "lobby": False,
+            "game_over": False,
+            "capacity": 6,
+            "votes": votes,
+            "roles": [],
+            "players": {name: ["specific." + name, False, True, False, "Guard", 0] for name in players},
+            "timers": [["end_cycle", 1234.5]],
+        }
+
+    def test_snapshot_and_patches_rebuild_the_latest_state(self):
+        store = SnapshotStore(self.path, "moderator.0", compact_every=3)
+
+        for votes in range(10):
+            store.track("a", self.state(votes, ["x", "y", "z"][: 1 + votes % 3]))
+        store.track("b", self.state(0, ["w"]))
+        store.track("c", self.state(0, ["v"]))
+        store.flush()
+        store.track("c", None)
+        store.flush()
+
+        restored = SnapshotStore(self.path, "moderator.0").load()
+        self.assertEqual(restored, {"a": self.state(9, ["x"]), "b": self.state(0, ["w"])})
+        self.assertEqual(SnapshotStore(self.path, "moderator.1").load(), {})
+
+
+class SnapshotRestoreTests(TestCase):
+    def setUp(self):
+        self.addCleanup(messages.take)
+
+    async def test_restarted_moderator_resumes_games_and_clears_orphans(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "snapshots.sqlite3")
+
+        with self.settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, MODERATOR_SNAPSHOTS=path):
+            orphan = await models.Game.objects.acreate(lobby_name="orphan")
+            user = await User.objects.acreate(username="stuck")
+            await models.Player.objects.filter(pk=user.pk).aupdate(ingame=orphan)
+
+            first = GameConsumer()
+            first.scope = {"type": "channel", "channel": "moderator.0"}
+            first.channel_layer = get_channel_layer()
+
+            for name in ("ann", "bob"):
+                await first.dispatch(
+                    {"type": "connect", "id": "saved", "username": name, "player_channel": "specific." + name}
+                )
+            game = first.games.get("saved")
+            game.lobby = False
+            await first.run_phase(game, first.cycle)
+            await first.flush_snapshots()
+
+            second = GameConsumer()
+            second.scope = {"type": "channel", "channel": "moderator.0"}
+            second.channel_layer = get_channel_layer()
+            await second.dispatch({"type": "restore"})
+
+            resumed = second.games.get("saved")
+            self.assertEqual(sorted(resumed.players), ["ann", "bob"])
+            self.assertFalse(resumed.lobby)
+            self.assertEqual([phase for phase, timer in resumed.timers], ["end_cycle"])
+            self.assertGreater(resumed.timers[0][1].remaining(), 45)
+
+            self.assertFalse(await models.Game.objects.filter(lobby_name="orphan").aexists())
+            self.assertIsNone((await models.Player.objects.aget(pk=user.pk)).ingame_id)
+
+    async def test_snapshots_are_written_off_the_loop_and_only_on_change(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "snapshots.sqlite3")
+
+        with self.settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS, MODERATOR_SNAPSHOTS=path):
+            moderator = GameConsumer()
+            moderator.scope = {"type": "channel", "channel": "moderator.0"}
+            moderator.channel_layer = get_channel_layer()
+            await moderator.dispatch(
+                {"type": "connect", "id": "still", "username": "ann", "player_channel": "specific.ann"}
+            )
+            game = moderator.games.get("still")
+            game.lobby = False
+            await moderator.run_phase(game, moderator.cycle)
+
+            threads = []
+            write = moderator.snapshots.write
+
+            def write_on_a_thread(pending):
+                threads.append(threading.get_ident())
+                write(pending)
+
+            moderator.snapshots.write = write_on_a_thread
+            moderator.snapshot_flush.cancel()
+            await moderator.flush_snapshots()
+            self.assertNotIn(threading.get_ident(), threads)
+
+            # A pending phase is saved the same way however often it's asked
+            state = game.to_state()
+            await asyncio.sleep(0.02)
+            self.assertEqual(game.to_state(), state)
+            moderator.save("still")
+            self.assertEqual(moderator.snapshots.pending, [])
+            game.cancel_timers()
+
+
+class MessageBufferTests(TransactionTestCase):
+    def setUp(self):
+        self.game = models.Game.objects.create(lobby_name="logged")
+        self.user = User.objects.create(username="talker")
+
+    async def test_batch_is_written_once_it_is_full(self):
+        buffer = MessageBuffer(max_size=3, max_delay=60)
+
+        buffer.add(("logged", "talker", "hello", False, False))
+        buffer.add(("logged", "talker", "talker voted for x", True, False))
+        self.assertEqual(await models.Game_Message.objects.acount(), 0)
+
+        buffer.add(("logged", None, "Game beginning!", False, True))
+        await buffer.drain()
+
+        rows = [
+            (row.sender_id, row.message, row.is_vote, row.is_status)
+            async for row in models.Game_Message.objects.filter(game=self.game).order_by("id")
+        ]
+        self.assertEqual(
+            rows,
+            [
+                (self.user.pk, "hello", False, False),
+                (self.user.pk, "talker voted for x", True, False),
+                (None, "Game beginning!", False, True),
+            ],
+        )
+
+    async def test_batch_is_written_once_it_has_waited(self):
+        buffer = MessageBuffer(max_size=100, max_delay=0.05)
+
+        buffer.add(("logged", "talker", "hello", False, False))
+        buffer.add(("closed", "talker", "gone", False, False))
+        await asyncio.sleep(0.1)
+        await buffer.drain()
+
+        self.assertEqual(await models.Game_Message.objects.acount(), 1)
+
+    async def test_batches_go_one_at_a_time_and_a_failed_one_is_kept(self):
+        buffer = MessageBuffer(max_size=1, max_delay=60)
+        batches = []
+
+        def write(batch):
+            batches.append([line for lobby, sender, line, *rest in batch])
+
+            if len(batches) == 1:
+                raise DatabaseError("database is locked")
+
+        buffer.write = write
+
+        # The later lines wait for the first batch instead of racing it
+        with self.assertLogs("palace.persistence", "ERROR"):
+            for line in ("one", "two", "three"):
+                buffer.add(("logged", "talker", line, False, False))
+
+            with self.assertRaises(DatabaseError):
+                await buffer.drain()
+
+        self.assertEqual(buffer.items[0][2], "one")
+        await buffer.drain()
+        self.assertEqual(batches, [["one"], ["one", "two", "three"]])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class OutboxTests(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(messages.take)
+
+    async def test_one_batch_per_recipient_for_each_event_handled(self):
+        layer = get_channel_layer()
+        moderator = GameConsumer()
+        moderator.channel_layer = layer
+        moderator.resumed = True
+
+        listener = await layer.new_channel()
+        await layer.group_add("palace_batched", listener)
+
+        game = moderator.games.open("batched")
+        for name, role in (("king", "King"), ("beast", "Beast")):
+            await moderator.connect(
+                {"type": "connect", "id": "batched", "username": name, "player_channel": "specific." + name}
+            )
+            game.players[name].role = role
+        game.lobby = False
+        moderator.outbox = {}
+
+        await moderator.dispatch(
+            {"type": "demand", "id": "batched", "demand": "j", "message": "king", "username": "beast"}
+        )
+
+        received = await layer.receive(listener)
+        self.assertEqual(received["type"], "frame")
+        frame = json.loads(received["text"])
+        self.assertEqual(frame["type"], "batch")
+        self.assertEqual(
+            [event["message"] for event in frame["events"]],
+            ["The King king has been jumped on!", "The beast wins!"],
+        )
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(listener), 0.05)
+
+    async def test_control_messages_keep_their_place_between_frames(self):
+        layer = get_channel_layer()
+        moderator = GameConsumer()
+        moderator.channel_layer = layer
+        listener = await layer.new_channel()
+
+        for event in (
+            {"type": "game_message", "message": "one", "theme": "light"},
+            {"type": "game_event", "event": "out", "player": "bob"},
+            {"type": "delete_lobby"},
+            {"type": "game_message", "message": "two", "theme": "light"},
+        ):
+            await moderator.message(dict(event, player_channel=listener))
+        await moderator.flush_outbox()
+
+        received = [await layer.receive(listener) for _ in range(3)]
+        self.assertEqual([event["type"] for event in received], ["frame", "delete_lobby", "frame"])
+        self.assertEqual(
+            [frame["type"] for frame in json.loads(received[0]["text"])["events"]],
+            ["broadcast", "event"],
+        )
+        self.assertEqual(json.loads(received[2]["text"])["message"], "two")
+
+    async def test_lobby_consumer_passes_frames_through(self):
+        consumer = LobbyConsumer()
+        consumer.binary = False
+        sent = []
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            sent.append(text_data)
+
+        consumer.send = send
+        message = protocol.frame_message([protocol.broadcast("Cycle finished!", "light")])
+        await consumer.frame(message)
+
+        self.assertEqual(sent, [message["text"]])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class RosterTests(TestCase):
+    def setUp(self):
+        self.addCleanup(messages.take)
+
+    async def receive_frames(self, layer, channel):
+        frame = json.loads((await layer.receive(channel))["text"])
+        return frame["events"] if frame["type"] == "batch" else [frame]
+
+    async def test_joins_and_leaves_are_one_versioned_broadcast(self):
+        layer = get_channel_layer()
+        moderator = GameConsumer()
+        moderator.channel_layer = layer
+        moderator.resumed = True
+        listener = await layer.new_channel()
+        await layer.group_add("palace_roster", listener)
+
+        channels = {}
+        for name in ("cat", "ann", "bob"):
+            await User.objects.acreate(username=name)
+            channels[name] = await layer.new_channel()
+            await moderator.dispatch(
+                {"type": "connect", "id": "roster", "username": name, "player_channel": channels[name]}
+            )
+
+        # The last one in got the whole list, sorted, at the latest version
+        self.assertEqual(
+            await self.receive_frames(layer, channels["bob"]),
+            [protocol.roster("full", 3, ["ann", "bob", "cat"])],
+        )
+
+        await moderator.dispatch(
+            {"type": "disconnect", "id": "roster", "username": "ann", "player_channel": channels["ann"]}
+        )
+
+        received = []
+        for _ in range(4):
+            received += await self.receive_frames(layer, listener)
+        self.assertEqual(
+            received,
+            [
+                protocol.roster("join", 1, ["cat"]),
+                protocol.roster("join", 2, ["ann"]),
+                protocol.roster("join", 3, ["bob"]),
+                protocol.roster("leave", 4, ["ann"]),
+            ],
+        )
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(listener), 0.05)
+
+    async def test_client_that_missed_a_change_gets_the_full_list(self):
+        layer = get_channel_layer()
+        moderator = GameConsumer()
+        moderator.channel_layer = layer
+        moderator.resumed = True
+        channel = await layer.new_channel()
+
+        await moderator.dispatch(
+            {"type": "connect", "id": "gap", "username": "ann", "player_channel": "specific.ann"}
+        )
+        await moderator.dispatch(
+            {
+                "type": "demand",
+                "id": "gap",
+                "demand": "r",
+                "message": "",
+                "username": "ann",
+                "player_channel": channel,
+            }
+        )
+
+        self.assertEqual(
+            await self.receive_frames(layer, channel), [protocol.roster("full", 1, ["ann"])]
+        )
+
+
+class ProtocolTests(SimpleTestCase):
+    frames = [
+        protocol.event("new_cycle", "Discuss and cast votes!", "light"),
+        protocol.event("role", player="ann", role="King"),
+        protocol.chat("hello " * 20, "ann"),
+        protocol.broadcast("The beast wins!", "dark"),
+        protocol.roster("join", 7, ["ann"]),
+        {"type": "other", "numbers": [0, -1, 127, 128, -33, 70000, 2**40], "none": None, "yes": True},
+    ]
+
+    def test_binary_frames_are_smaller_than_json(self):
+        for frame in self.frames[:5]:
+            self.assertLess(len(protocol.encode_binary([frame])), len(protocol.encode([frame])))
+
+        # Game events are mostly keys, those shrink the most
+        self.assertLess(len(protocol.encode_binary(self.frames[:2])), len(protocol.encode(self.frames[:2])) / 2)
+
+    def test_binary_frames_are_valid_messagepack(self):
+        try:
+            import msgpack
+        except ImportError:
+            self.skipTest("msgpack is not installed")
+
+        self.assertEqual(
+            msgpack.unpackb(protocol.encode_binary(self.frames)),
+            [0, [protocol.compact(frame) for frame in self.frames]],
+        )
+        self.assertEqual(msgpack.unpackb(protocol.pack("é" * 300)), "é" * 300)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class SubprotocolTests(TestCase):
+    async def connect(self, subprotocols):
+        user = await User.objects.acreate(username="ann%d" % len(subprotocols))
+        communicator = WebsocketCommunicator(
+            URLRouter(routing.websocket_urlpatterns), "/ws/palace/proto/", subprotocols=subprotocols
+        )
+        communicator.scope["user"] = user
+        communicator.scope["session"] = {}
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def test_binary_is_negotiated_when_asked_for(self):
+        communicator, subprotocol = await self.connect([protocol.BINARY, protocol.JSON])
+        self.assertEqual(subprotocol, protocol.BINARY)
+
+        frame = protocol.broadcast("Cycle finished!", "light")
+        await get_channel_layer().group_send("palace_proto", protocol.frame_message([frame]))
+        self.assertEqual(await communicator.receive_from(), protocol.encode_binary([frame]))
+        await communicator.disconnect()
+
+    async def test_json_is_the_fallback(self):
+        for subprotocols, expected in (([protocol.JSON], protocol.JSON), ([], None)):
+            communicator, subprotocol = await self.connect(subprotocols)
+            self.assertEqual(subprotocol, expected)
+
+            frame = protocol.broadcast("Cycle finished!", "light")
+            await get_channel_layer().group_send("palace_proto", protocol.frame_message([frame]))
+            self.assertEqual(await communicator.receive_json_from(), frame)
+            await communicator.disconnect()
+
+
+class PlayerAuthTests(TestCase):
+    def setUp(self):
+        auth.sessions.items.clear()
+        self.addCleanup(auth.sessions.items.clear)
+
+    def resolve(self, session_key):
+        scope = {"session": SessionStore(session_key)}
+        middleware = PlayerAuthMiddleware(None)
+        middleware.populate_scope(scope)
+        async_to_sync(middleware.resolve_scope)(scope)
+        return scope["user"]
+
+    def login(self, username):
+        user = User.objects.create_user(username=username, password="secret")
+        self.client.force_login(user)
+        return user, self.client.session.session_key
+
+    def test_user_and_player_come_from_one_lookup(self):
+        user, session_key = self.login("ann")
+
+        # One query for the session, one for the user and its player
+        with self.assertNumQueries(2):
+            user = self.resolve(session_key)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(user.player.player, "ann")
+
+    def test_repeat_handshakes_are_served_from_the_cache(self):
+        user, session_key = self.login("cat")
+        self.resolve(session_key)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.resolve(session_key).player.player, "cat")
+            self.assertFalse(self.resolve(None).is_authenticated)
+
+    def test_logout_and_password_change_drop_cached_sessions(self):
+        user, session_key = self.login("bob")
+        self.assertTrue(self.resolve(session_key).is_authenticated)
+        self.client.logout()
+        self.assertFalse(self.resolve(session_key).is_authenticated)
+
+        user, session_key = self.login("dan")
+        self.assertTrue(self.resolve(session_key).is_authenticated)
+        user.set_password("other")
+        user.save()
+        self.assertFalse(self.resolve(session_key).is_authenticated)
+
+    def test_shared_cache_is_checked_against_the_users_version(self):
+        with self.settings(PLAYER_AUTH_SHARED_CACHE="default"):
+            user, session_key = self.login("eve")
+            self.resolve(session_key)
+
+            # Another process, with nothing cached locally yet
+            auth.sessions.items.clear()
+            with self.assertNumQueries(0):
+                self.assertTrue(self.resolve(session_key).is_authenticated)
+
+            auth.sessions.items.clear()
+            auth.forget_user(user.pk)
+            self.assertIsNone(async_to_sync(auth.cached_user)(session_key))
+
+    def test_a_local_hit_is_dropped_once_another_process_forgets_the_user(self):
+        with self.settings(PLAYER_AUTH_SHARED_CACHE="default"):
+            user, session_key = self.login("fay")
+            self.resolve(session_key)
+            self.assertIn(session_key, auth.sessions.items)
+
+            # Another process changes the password, only the shared cache hears of it
+            shared = auth.shared_cache()
+            shared.set(auth.user_cache_key(user.pk), time.time_ns(), None)
+            self.assertIsNone(async_to_sync(auth.cached_user)(session_key))
+            self.assertNotIn(session_key, auth.sessions.items)
+
+            # And a logout there drops the session here too
+            user, session_key = self.login("gus")
+            self.resolve(session_key)
+            shared.delete(auth.session_cache_key(session_key))
+            self.assertIsNone(async_to_sync(auth.cached_user)(session_key))
+
+
+class TTLCacheTests(SimpleTestCase):
+    def test_entries_expire_and_the_least_recently_used_goes_first(self):
+        clock = FakeClock()
+        cache = TTLCache(max_size=2, ttl=10, clock=clock)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+
+        clock.now += 10
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 1)
+
+
+class OccupancyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(messages.take)
+
+    def join(self, username, lobby_name):
+        user = User.objects.create_user(username=username)
+        self.client.force_login(user)
+        return self.client.get(reverse("palace:lobby", args=[lobby_name]))
+
+    def test_players_take_seats_until_the_lobby_is_full(self):
+        models.Game.objects.create(lobby_name="small", capacity=2)
+
+        self.join("ann", "small")
+
+        # Coming back to the lobby doesn't write anything
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("palace:lobby", args=["small"]))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries if not query["sql"].startswith("SELECT")])
+        self.join("bob", "small")
+        self.assertContains(self.join("cat", "small"), "This lobby is full")
+
+        self.assertEqual(models.Game.objects.get(lobby_name="small").occupancy, 2)
+        self.assertIsNone(models.Player.objects.get(player="cat").ingame)
+
+        # Nor does trying another lobby while seated in this one
+        models.Game.objects.create(lobby_name="other")
+        self.client.force_login(User.objects.get(username="ann"))
+        self.assertContains(
+            self.client.get(reverse("palace:lobby", args=["other"])), "in a game already"
+        )
+        self.assertEqual(models.Game.objects.get(lobby_name="other").occupancy, 0)
+
+    def test_open_lobbies_fullest_first(self):
+        for lobby_name, occupancy in (("a", 1), ("b", 6), ("c", 4), ("d", 0)):
+            models.Game.objects.create(lobby_name=lobby_name, occupancy=occupancy)
+
+        self.assertEqual(
+            list(models.Game.objects.open().values_list("lobby_name", flat=True)),
+            ["c", "a", "d"],
+        )
+        response = self.client.get(reverse("palace:games"))
+        self.assertContains(response, "4/6")
+        self.assertNotContains(response, "6/6")
+
+    async def test_leaving_the_lobby_gives_up_the_seat(self):
+        with self.settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS):
+            game = await models.Game.objects.acreate(lobby_name="seats", occupancy=2)
+            for name in ("ann", "bob"):
+                user = await User.objects.acreate(username=name)
+                await models.Player.objects.filter(pk=user.pk).aupdate(ingame=game)
+
+            moderator = GameConsumer()
+            moderator.channel_layer = get_channel_layer()
+            moderator.resumed = True
+
+            for name in ("ann", "bob"):
+                await moderator.dispatch(
+                    {"type": "connect", "id": "seats", "username": name, "player_channel": "specific." + name}
+                )
+            await moderator.dispatch(
+                {"type": "disconnect", "id": "seats", "username": "ann", "player_channel": "specific.ann"}
+            )
+            # A second leave for the same player doesn't give up another seat
+            await moderator.dispatch(
+                {"type": "disconnect", "id": "seats", "username": "ann", "player_channel": "specific.ann"}
+            )
+            await database_sync_to_async(moderator.player_writes.flush_now)()
+
+            self.assertEqual(moderator.games.get("seats").player_count, 1)
+            self.assertEqual((await models.Game.objects.aget(pk=game.pk)).occupancy, 1)
+            self.assertIsNone((await models.Player.objects.aget(player="ann")).ingame_id)
+
+    async def test_a_reload_keeps_the_seat(self):
+        with self.settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS):
+            game = await models.Game.objects.acreate(lobby_name="reload", capacity=3, occupancy=2)
+            for name in ("ann", "bob"):
+                user = await User.objects.acreate(username=name)
+                await models.Player.objects.filter(pk=user.pk).aupdate(ingame=game)
+
+            moderator = GameConsumer()
+            moderator.channel_layer = get_channel_layer()
+            moderator.resumed = True
+            await moderator.dispatch(
+                {"type": "connect", "id": "reload", "username": "bob", "player_channel": "specific.bob"}
+            )
+
+            async def event(kind, channel):
+                await moderator.dispatch(
+                    {"type": kind, "id": "reload", "username": "ann", "player_channel": channel}
+                )
+                await database_sync_to_async(moderator.player_writes.flush_now)()
+
+            async def seated():
+                player = await models.Player.objects.aget(player="ann")
+                row = await models.Game.objects.aget(pk=game.pk)
+                return player.ingame_id == game.pk, row.occupancy
+
+            # The new socket connects before the old one's disconnect
+            await event("connect", "specific.one")
+            await event("connect", "specific.two")
+            await event("disconnect", "specific.one")
+            self.assertEqual(list(moderator.games.get("reload").players), ["bob", "ann"])
+            self.assertEqual(await seated(), (True, 2))
+
+            # Or after it, once the seat has been given back
+            await event("disconnect", "specific.two")
+            self.assertEqual(await seated(), (False, 1))
+            await event("connect", "specific.three")
+            self.assertEqual(await seated(), (True, 2))
+
+            # Both in one batch
+            await moderator.dispatch(
+                {"type": "disconnect", "id": "reload", "username": "ann", "player_channel": "specific.three"}
+            )
+            await event("connect", "specific.four")
+            self.assertEqual(await seated(), (True, 2))
+
+    async def test_a_started_game_frees_its_seats_once_everyone_leaves(self):
+        with self.settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS):
+            row = await models.Game.objects.acreate(lobby_name="played", capacity=2, occupancy=2)
+            for name in ("ann", "bob"):
+                user = await User.objects.acreate(username=name)
+                await models.Player.objects.filter(pk=user.pk).aupdate(ingame=row)
+
+            moderator = GameConsumer()
+            moderator.channel_layer = get_channel_layer()
+            moderator.resumed = True
+            game = moderator.games.open("played")
+            game.capacity = 2
+
+            for name in ("ann", "bob"):
+                await moderator.dispatch(
+                    {"type": "connect", "id": "played", "username": name, "player_channel": "specific." + name}
+                )
+            game.countdown.cancel()
+            await moderator.assign_roles(game)
+            await database_sync_to_async(moderator.player_writes.flush_now)()
+            self.assertTrue((await models.Game.objects.aget(pk=row.pk)).in_progress)
+
+            for name in ("ann", "bob"):
+                await moderator.dispatch(
+                    {"type": "disconnect", "id": "played", "username": name, "player_channel": "specific." + name}
+                )
+            await database_sync_to_async(moderator.player_writes.flush_now)()
+
+            self.assertNotIn("played", moderator.games)
+            self.assertFalse(await models.Game.objects.filter(pk=row.pk).aexists())
+            self.assertFalse(await models.Player.objects.filter(ingame__isnull=False).aexists())
+
+    def test_write_queue_coalesces_leaves_per_lobby(self):
+        for lobby_name in ("one", "two"):
+            game = models.Game.objects.create(lobby_name=lobby_name, occupancy=3)
+            for seat in range(3):
+                user = User.objects.create_user(username="%s%d" % (lobby_name, seat))
+                models.Player.objects.filter(pk=user.pk).update(ingame=game)
+
+        def write(batch):
+            queue = PlayerWriteQueue()
+            queue.items = batch
+            with CaptureQueriesContext(connection) as queries:
+                queue.flush_now()
+            return len(queries)
+
+        # However many players leave a lobby together, it costs the same
+        one = write([("leave", "one", "one0"), ("leave", "one", "one0")])
+        two = write([("leave", "two", name) for name in ("two0", "two1", "two2")])
+        self.assertEqual(one, two)
+
+        write([("close", "one", None), ("close", "two", None)])
+        self.assertEqual(models.Game.objects.get(lobby_name="one").occupancy, 2)
+        self.assertFalse(models.Game.objects.filter(lobby_name="two").exists())
+        self.assertEqual(models.Player.objects.filter(ingame__isnull=False).count(), 2)
+
+
+class LobbyBrowserTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def walk(self, show):
+        names = []
+        url = reverse("palace:games") + "?show=" + show
+
+        while url:
+            response = self.client.get(url)
+            names += [lobby.lobby_name for lobby in response.context["page"].items()]
+            after = response.context["page"].next()
+            url = after and reverse("palace:games") + "?show=%s&after=%s" % (show, after)
+
+        return names
+
+    def test_pages_cover_every_lobby_once_in_order(self):
+        models.Game.objects.bulk_create(
+            [models.Game(lobby_name="l%02d" % number, occupancy=number % 6) for number in range(45)]
+            + [models.Game(lobby_name="p%d" % number, occupancy=6, in_progress=True) for number in range(3)]
+        )
+
+        expected = sorted(
+            ("l%02d" % number for number in range(45)),
+            key=lambda name: (-(int(name[1:]) % 6), name),
+        )
+        self.assertEqual(self.walk("open"), expected)
+        self.assertEqual(self.walk("playing"), ["p0", "p1", "p2"])
+
+    def test_pages_are_cached_until_someone_joins(self):
+        models.Game.objects.create(lobby_name="first", occupancy=1)
+        self.assertContains(self.client.get(reverse("palace:games")), "first")
+
+        # Only the generation is looked up
+        with self.assertNumQueries(1):
+            self.client.get(reverse("palace:games"))
+
+        user = User.objects.create_user(username="ann")
+        self.client.force_login(user)
+        self.client.get(reverse("palace:lobby", args=["second"]))
+        self.client.logout()
+
+        response = self.client.get(reverse("palace:games"))
+        self.assertContains(response, "second")
+        self.assertContains(response, "1/6", count=2)
+
+        # A moderator's write is seen through the database, whatever
+        # process it ran in and whichever cache that process has
+        generation = models.LobbyGeneration.objects.get().value
+        queue = PlayerWriteQueue()
+        queue.items = [("leave", "second", "ann")]
+        queue.flush_now()
+        self.assertEqual(models.LobbyGeneration.objects.get().value, generation + 1)
+        self.assertContains(self.client.get(reverse("palace:games")), "0/6")
+
+
+# Every statement the hot paths send, run through EXPLAIN QUERY PLAN.
+# A plan line that scans a whole table without an index fails the test.
+class QueryPlanTests(TestCase):
+    FULL_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW)\S+( AS \S+)?$")
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(messages.take)
+
+        if connection.vendor != "sqlite":
+            self.skipTest("Plans are checked against SQLite")
+
+    def assertNoFullScans(self, queries):
+        scans = []
+
+        for query in queries:
+            sql = query["sql"]
+
+            if not sql.startswith(("SELECT", "UPDATE", "DELETE", "INSERT")):
+                continue
+
+            with connection.cursor() as cursor:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql)
+                plan = [row[-1] for row in cursor.fetchall()]
+
+            scans += [(line, sql) for line in plan if self.FULL_SCAN.match(line)]
+
+        self.assertEqual(scans, [])
+
+    def test_views_use_indexes(self):
+        user = User.objects.create_user(username="ann")
+        models.Game.objects.create(lobby_name="busy", occupancy=3, in_progress=True)
+        self.client.force_login(user)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("palace:player", args=["ann"]))
+            self.client.get(reverse("palace:lobby", args=["plans"]))
+            self.client.get(reverse("palace:lobby", args=["plans"]))
+            self.client.get(reverse("palace:games"))
+            self.client.get(reverse("palace:games") + "?show=playing&after=3.busy")
+
+        self.assertNoFullScans(queries)
+
+    def test_moderator_writes_use_indexes(self):
+        game = models.Game.objects.create(lobby_name="plans", occupancy=2)
+        for name in ("ann", "bob"):
+            user = User.objects.create_user(username=name)
+            models.Player.objects.filter(pk=user.pk).update(ingame=game)
+
+        writes = PlayerWriteQueue()
+        writes.items = [("leave", "plans", "ann"), ("start", "plans", None)]
+        writes.items += [("leave", "plans", "bob"), ("close", "plans", None)]
+        buffer = MessageBuffer()
+        buffer.items = [("plans", "ann", "hi", False, False), ("plans", None, "Go!", False, True)]
+
+        with CaptureQueriesContext(connection) as queries:
+            buffer.flush_now()
+            writes.flush_now()
+            list(models.Game_Message.objects.filter(game=game).order_by("timestamp", "id"))
+
+        self.assertNoFullScans(queries)
+
+    def test_history_uses_indexes(self):
+        game = models.Game.objects.create(lobby_name="plans")
+        models.Game_Message.objects.create(game=game, message="hi", is_vote=False, is_status=True)
+        log = History(size=1)
+
+        with CaptureQueriesContext(connection) as queries:
+            log.recent("plans")
+            lines, before = log.recent("plans")
+            log.before("plans", before)
+
+        self.assertNoFullScans(queries)
+
+
+class DatabaseProfileTests(TestCase):
+    def test_sqlite_connections_are_tuned(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("SQLite profile only")
+
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA synchronous")
+            # 1 is NORMAL
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class LeaderboardTests(TestCase):
+    def test_ranks_follow_each_win(self):
+        board = Leaderboard()
+        board.load([("ann", 3), ("bob", 1), ("cat", 3), ("dan", 0)])
+
+        self.assertEqual(board.top(3), [("ann", 3), ("cat", 3), ("bob", 1)])
+        self.assertEqual([board.rank(name) for name in ("ann", "cat", "bob", "dan")], [1, 1, 3, 4])
+
+        board.update([("dan", 2), ("bob", 2)])
+        self.assertEqual(board.top(4), [("ann", 3), ("cat", 3), ("bob", 2), ("dan", 2)])
+        board.update([("dan", 4)])
+        self.assertEqual(board.rank("dan"), 1)
+        self.assertEqual(board.rank("cat"), 2)
+        self.assertIsNone(board.rank("eve"))
+
+    async def test_moderator_records_the_winners(self):
+        with self.settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS):
+            self.addCleanup(messages.take)
+            await models.Game.objects.acreate(lobby_name="won", in_progress=True)
+            moderator = GameConsumer()
+            moderator.channel_layer = get_channel_layer()
+            moderator.resumed = True
+            game = moderator.games.open("won")
+
+            for name, role in (("king", "King"), ("beast", "Beast"), ("guard", "Guard")):
+                await User.objects.acreate(username=name)
+                await moderator.connect(
+                    {"type": "connect", "id": "won", "username": name, "player_channel": "specific." + name}
+                )
+                game.players[name].role = role
+            game.lobby = False
+
+            # A web process, following the wins the moderator sends
+            board = Leaderboard(max_age=0)
+
+            async def application(scope, receive, send):
+                pass
+
+            follower = FollowWins(application, board)
+            await follower({"type": "http"}, None, None)
+
+            while not board.following:
+                await asyncio.sleep(0.01)
+            await database_sync_to_async(board.warm)()
+
+            for _ in range(2):
+                await moderator.dispatch(
+                    {"type": "demand", "id": "won", "demand": "j", "message": "guard", "username": "beast"}
+                )
+
+            # Only the winners are read back, the board isn't loaded again
+            def write():
+                with CaptureQueriesContext(connection) as queries:
+                    moderator.player_writes.flush_now()
+                    board.warm()
+                return [query["sql"] for query in queries]
+
+            queries = await database_sync_to_async(write)()
+            self.assertFalse([sql for sql in queries if '"wins"' in sql and "WHERE" not in sql])
+
+            for _ in range(100):
+                if board.top(2) == [("guard", 1), ("king", 1)]:
+                    break
+                await asyncio.sleep(0.01)
+
+            wins = {
+                player.player: player.wins
+                async for player in models.Player.objects.all()
+            }
+            self.assertEqual(wins, {"king": 1, "beast": 0, "guard": 1})
+
+            # The wins stay once the lobby closes and its game is deleted
+            moderator.player_writes.close("won")
+            await database_sync_to_async(moderator.player_writes.flush_now)()
+            self.assertFalse(await models.Game.objects.filter(lobby_name="won").aexists())
+            self.assertEqual(
+                sorted([win.player_id async for win in models.Win.objects.filter(lobby_name="won")]),
+                sorted([player.pk async for player in models.Player.objects.filter(player__in=["guard", "king"])]),
+            )
+            self.assertEqual(board.top(2), [("guard", 1), ("king", 1)])
+            self.assertEqual(board.rank("beast"), 3)
+
+            follower.task.cancel()
+            await asyncio.gather(follower.task, return_exceptions=True)
+            self.assertFalse(board.following)
+
+        self.addCleanup(setattr, leaderboard, "loaded", None)
+        response = await self.async_client.get(reverse("palace:leaderboard"))
+        self.assertContains(response, "#1")
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+class ProfileTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="ann")
+        models.Game.objects.create(lobby_name="won")
+        self.client.force_login(self.user)
+
+    def test_repeat_views_are_not_modified(self):
+        url = reverse("palace:player", args=["ann"])
+        response = self.client.get(url)
+        self.assertContains(response, "ann's wins: 0")
+        etag = response["ETag"]
+        self.assertTrue(response.has_header("Last-Modified"))
+
+        with self.assertNumQueries(3), self.assertTemplateNotUsed("palace/profile.html"):
+            response = self.client.get(url, headers={"if-none-match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        PlayerWriteQueue().write([("win", "won", ("ann",))])
+
+        response = self.client.get(url, headers={"if-none-match": etag})
+        self.assertContains(response, "ann's wins: 1")
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_own_profile_renders_in_place(self):
+        response = self.client.get(reverse("palace:profile"))
+        self.assertContains(response, "ann's Profile")
+
+        self.client.logout()
+        response = self.client.get(reverse("palace:player", args=["ann"]))
+        self.assertContains(response, "ann's Profile")
+        self.assertEqual(self.client.get(reverse("palace:player", args=["bob"])).status_code, 404)
+
+
+class HistoryTests(TestCase):
+    def setUp(self):
+        self.game = models.Game.objects.create(lobby_name="log")
+        self.ann = User.objects.create_user(username="ann").player
+        self.say(range(60))
+
+    def say(self, lines):
+        models.Game_Message.objects.bulk_create(
+            models.Game_Message(
+                game=self.game,
+                sender=self.ann if line % 2 else None,
+                message="line %d" % line,
+                is_vote=False,
+                is_status=not line % 2,
+            )
+            for line in lines
+        )
+
+    def test_replay_only_reads_what_is_new(self):
+        log = History(size=10)
+        lines, before = log.recent("log")
+        self.assertEqual(lines[0], ["", "line 50"])
+        self.assertEqual(lines[-1], ["ann", "line 59"])
+        self.assertIsNotNone(before)
+
+        self.say(range(60, 63))
+
+        with CaptureQueriesContext(connection) as queries:
+            lines, before = log.recent("log")
+        self.assertEqual([message for sender, message in lines], ["line %d" % line for line in range(53, 63)])
+        self.assertEqual(len(queries), 2)
+        self.assertIn('"timestamp" >=', queries[1]["sql"])
+        self.assertIn("LIMIT 10", queries[1]["sql"])
+
+        self.assertEqual(History().recent("nowhere"), ([], None))
+
+    def test_older_pages_follow_the_cursor(self):
+        # Lines written in one batch can share a timestamp, ids keep them apart
+        models.Game_Message.objects.update(timestamp=self.game.messages.first().timestamp)
+        log = History(size=7)
+        lines, before = log.recent("log")
+        seen = lines
+
+        while before:
+            lines, before = log.before("log", before)
+            seen = lines + seen
+
+        self.assertEqual([message for sender, message in seen], ["line %d" % line for line in range(60)])
+        self.assertEqual(log.before("log", "nonsense"), ([], None))
+
+    async def test_lines_are_sent_on_connect(self):
+        with self.settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS):
+            communicator = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), "/ws/palace/log/"
+            )
+            communicator.scope["user"] = await User.objects.select_related("player").aget(username="ann")
+            communicator.scope["session"] = {}
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+
+            frame = await communicator.receive_json_from()
+            self.assertEqual(frame["type"], "history")
+            self.assertEqual(len(frame["lines"]), 50)
+
+            await communicator.send_json_to({"message": "h>" + frame["before"]})
+            frame = await communicator.receive_json_from()
+            self.assertEqual(frame["lines"][-1], ["ann", "line 9"])
+            self.assertEqual(frame["before"], "")
+            await communicator.disconnect()
+
+
+class SingleNodeTests(TestCase):
+    async def test_moderators_run_in_the_server_process(self):
+        layers = {"default": {"BACKEND": "palace.node.InProcessChannelLayer"}}
+
+        with self.settings(CHANNEL_LAYERS=layers, MODERATOR_SHARDS=2, MODERATOR_SNAPSHOTS=None):
+            application = InProcessModerators(
+                ProtocolTypeRouter(
+                    {
+                        "channel": ChannelNameRouter(
+                            {channel: GameConsumer.as_asgi() for channel in moderator_channels()}
+                        )
+                    }
+                )
+            )
+            lifespan = asyncio.Queue()
+            sent = asyncio.Queue()
+            server = asyncio.ensure_future(
+                application({"type": "lifespan"}, lifespan.get, sent.put)
+            )
+            await lifespan.put({"type": "lifespan.startup"})
+            self.assertEqual(await sent.get(), {"type": "lifespan.startup.complete"})
+
+            layer = get_channel_layer()
+            player = await layer.new_channel()
+            await layer.send(
+                moderator_for("solo"),
+                {"type": "connect", "id": "solo", "username": "ann", "player_channel": player},
+            )
+            frame = json.loads((await asyncio.wait_for(layer.receive(player), 5))["text"])
+            self.assertEqual(frame["players"], ["ann"])
+
+            await lifespan.put({"type": "lifespan.shutdown"})
+            self.assertEqual(await sent.get(), {"type": "lifespan.shutdown.complete"})
+            await server
+            self.assertTrue(application.task.done())
+
+    async def test_moderator_channels_get_their_own_capacity(self):
+        layer = InProcessChannelLayer(capacity=2, channel_capacity={"moderator.*": 5})
+        self.assertEqual(layer.get_capacity("moderator.0"), 5)
+        self.assertEqual(layer.get_capacity("specific.abc!def"), 2)
+
+
+class LayerTests(SimpleTestCase):
+    def layer(self, policy="drop_chat", **options):
+        return InstrumentedChannelLayer(
+            {"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 10000}},
+            policy=policy,
+            slow_depth=20,
+            **options,
+        )
+
+    # 200 chat lines from someone flooding, with a game event every 50
+    async def flood(self, layer, lines=200):
+        channel = await layer.new_channel()
+        await layer.group_add("palace_flood", channel)
+
+        for line in range(lines):
+            await layer.group_send(
+                "palace_flood", protocol.frame_message([protocol.chat("spam %d" % line, "bob")])
+            )
+
+            if line % 50 == 0:
+                await layer.group_send(
+                    "palace_flood", protocol.frame_message([protocol.broadcast("Vote!", "light")])
+                )
+
+        return channel
+
+    async def drain(self, layer, channel):
+        received = [await layer.receive(channel)]
+
+        while layer.buffers[channel].entries:
+            received.append(await layer.receive(channel))
+
+        return received
+
+    async def test_game_events_outlast_a_chat_flood(self):
+        layer = self.layer()
+        channel = await self.flood(layer)
+        received = await self.drain(layer, channel)
+
+        self.assertEqual(len([message for message in received if not message["chat"]]), 4)
+        self.assertEqual(len(received), 23)
+        stats = layer.stats()
+        self.assertEqual(stats["groups"]["palace_flood"]["sent"], 204)
+        self.assertEqual(stats["groups"]["palace_flood"]["dropped"], 181)
+        self.assertEqual(stats["channels"][channel]["delivered"], 23)
+        self.assertEqual(stats["channels"][channel]["peak"], 23)
+        self.assertEqual(stats["totals"]["slow"], 1)
+
+    async def test_coalesced_frames_arrive_as_one_batch(self):
+        layer = self.layer("coalesce")
+        channel = await self.flood(layer)
+        received = await self.drain(layer, channel)
+
+        self.assertEqual(len(received), 20)
+        batch = json.loads(received[-1]["text"])
+        self.assertEqual(len(batch["events"]), 185)
+        self.assertEqual(batch["events"][-1], protocol.chat("spam 199", "bob"))
+        self.assertFalse(received[-1]["chat"])
+        self.assertEqual(layer.totals["coalesced"], 184)
+
+        try:
+            import msgpack
+        except ImportError:
+            return None
+
+        kind, events = msgpack.unpackb(received[-1]["bytes"])
+        self.assertEqual(len(events), 185)
+        self.assertEqual(events[-1], protocol.compact(protocol.chat("spam 199", "bob")))
+
+    async def test_slow_sockets_can_be_closed(self):
+        layer = self.layer("disconnect")
+        channel = await self.flood(layer)
+        received = await self.drain(layer, channel)
+
+        self.assertEqual(received, [{"type": "layer.overflow"}])
+        self.assertEqual(layer.totals["dropped"], 204)
+
+        consumer = LobbyConsumer()
+        sent = []
+
+        async def base_send(message):
+            sent.append(message)
+
+        consumer.base_send = base_send
+        await consumer.layer_overflow(received[0])
+        self.assertEqual(sent, [{"type": "websocket.close", "code": 4008}])
+
+    async def test_stale_chat_expires(self):
+        layer = self.layer(classes={"chat": {"capacity": 100, "expiry": -1}})
+        channel = await self.flood(layer, lines=5)
+        await layer.group_send(
+            "palace_flood", protocol.frame_message([protocol.broadcast("Day!", "light")])
+        )
+
+        first = await layer.receive(channel)
+        second = await layer.receive(channel)
+        self.assertEqual(json.loads(first["text"])["message"], "Vote!")
+        self.assertEqual(json.loads(second["text"])["message"], "Day!")
+        self.assertEqual(layer.totals["expired"], 5)
+        self.assertEqual(layer.stats()["groups"]["palace_flood"]["expired"], 5)
+
+    async def test_buffers_go_with_their_consumer(self):
+        layer = self.layer()
+        channel = await layer.new_channel()
+        receiving = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(0)
+        self.assertIn(channel, layer.stats()["channels"])
+
+        receiving.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await receiving
+        self.assertEqual(layer.buffers, {})
+
+        # Moderator channels aren't buffered
+        await layer.send("moderator.0", {"type": "restore"})
+        self.assertEqual((await layer.receive("moderator.0"))["type"], "restore")
+        self.assertEqual(layer.buffers, {})
+
+    async def test_a_full_channel_does_not_stop_the_moderators_flush(self):
+        layer = InstrumentedChannelLayer(
+            {"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 1}}
+        )
+        await layer.send("specific.stuck", {"type": "frame", "text": "{}", "chat": False})
+
+        moderator = GameConsumer()
+        moderator.channel_layer = layer
+        for name in ("stuck", "fine"):
+            await moderator.message(
+                {"type": "game_message", "player_channel": "specific." + name, "message": "hi", "theme": ""}
+            )
+
+        with self.assertLogs("palace.layers", "WARNING"):
+            await moderator.flush_outbox()
+
+        self.assertEqual(json.loads((await layer.receive("specific.fine"))["text"])["message"], "hi")
+        self.assertEqual(layer.stats()["totals"], {"sent": 2, "dropped": 1})
+
+
+class RateLimitTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def test_buckets_refill_up_to_their_burst(self):
+        bucket = TokenBucket(2, 3, clock=self.clock)
+        bucket.tokens -= 3
+        self.assertEqual(bucket.wait(), 0.5)
+
+        self.now = 0.5
+        self.assertEqual(bucket.wait(), 0)
+        self.now = 100
+        self.assertEqual(bucket.refill(), 3)
+
+    def test_a_users_sockets_share_a_budget(self):
+        limits = RateLimits({"chat": {"connection": (1, 3), "user": (1, 4)}}, clock=self.clock)
+        first, second = limits.connection(), limits.connection()
+
+        self.assertEqual([limits.take(first, "ann", "chat") for _ in range(4)], [0, 0, 0, 1.0])
+        # The user's bucket has one token left, this socket's are spent
+        self.assertEqual(limits.take(second, "ann", "chat"), 0)
+        self.assertEqual(limits.take(second, "ann", "chat"), 1.0)
+        self.assertEqual(limits.take(limits.connection(), "bob", "chat"), 0)
+
+        self.now = 1
+        self.assertEqual(limits.take(first, "ann", "chat"), 0)
+
+    async def test_excess_is_turned_away_before_the_layer(self):
+        limits = RateLimits(
+            {"chat": {"connection": (0.01, 2), "user": (1, 5)}, "command": {"connection": (1, 5), "user": (1, 5)}}
+        )
+
+        with self.settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS), mock.patch("palace.consumers.limits", limits):
+            communicator = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), "/ws/palace/spam/"
+            )
+            communicator.scope["user"] = mock.Mock(player=mock.Mock(player="spammer"))
+            communicator.scope["session"] = {}
+            with mock.patch("palace.consumers.history.recent", return_value=([], None)):
+                connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.addCleanup(messages.take)
+
+            for line in range(4):
+                await communicator.send_json_to({"message": "spam %d" % line})
+
+            received = [await communicator.receive_json_from() for _ in range(3)]
+            self.assertEqual([frame["type"] for frame in received], ["chat", "chat", "error"])
+            self.assertEqual(received[2]["code"], "rate_limited")
+            self.assertGreater(received[2]["retry"], 1000)
+            self.assertTrue(await communicator.receive_nothing())
+
+            # Commands have their own budget
+            await communicator.send_json_to({"message": "r>"})
+            layer = get_channel_layer()
+            self.assertEqual((await layer.receive(moderator_for("spam")))["type"], "connect")
+            self.assertEqual((await layer.receive(moderator_for("spam")))["demand"], "r")
+            await communicator.disconnect()
+
+
+# The real Redis layers, pub/sub for broadcasts and lists for the
+# moderators, each process with its own, all talking to one fakeredis
+# server. The list layer's Lua scripts need lupa.
+class HybridLayerTests(SimpleTestCase):
+    def setUp(self):
+        try:
+            import fakeredis
+            import lupa
+        except ImportError:
+            self.skipTest("fakeredis and lupa are not installed")
+
+        hosts = {
+            "hosts": [
+                {"connection_class": fakeredis.aioredis.FakeConnection, "server": fakeredis.FakeServer()}
+            ]
+        }
+        self.config = {
+            "BACKEND": "palace.layers.HybridChannelLayer",
+            "CONFIG": {
+                "broadcast": {"BACKEND": "channels_redis.pubsub.RedisPubSubChannelLayer", "CONFIG": hosts},
+                "queued": {"BACKEND": "channels_redis.core.RedisChannelLayer", "CONFIG": hosts},
+            },
+        }
+        self.layers = []
+
+    # One process's layer, its connections are closed with the test's loop
+    def layer(self, layer=None):
+        layer = layer or make_layer(self.config)
+        self.layers.append(layer)
+        return layer
+
+    async def close(self):
+        for layer in self.layers:
+            await layer.flush()
+
+    async def test_moderator_channels_stay_queued(self):
+        web, moderator = self.layer(), self.layer()
+
+        try:
+            # Sent while no moderator is listening, say while one
+            # restarts, the list keeps it
+            await web.send("moderator.0", {"type": "demand", "demand": "v"})
+            self.assertEqual((await moderator.receive("moderator.0"))["demand"], "v")
+
+            # Pub/sub would have lost it, nothing waits for a subscriber
+            await moderator.send("specific.later", {"type": "frame", "text": "lost"})
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(web.receive("specific.later"), 0.1)
+        finally:
+            await self.close()
+
+    async def test_broadcasts_reach_each_process_subscribed(self):
+        web, other, moderator = self.layer(), self.layer(), self.layer()
+
+        try:
+            sockets = [await web.new_channel(), await other.new_channel()]
+            await web.group_add("palace_hybrid", sockets[0])
+            await other.group_add("palace_hybrid", sockets[1])
+
+            # One publish, every process with a member gets it
+            await moderator.group_send("palace_hybrid", {"type": "frame", "text": "hi"})
+            self.assertEqual((await web.receive(sockets[0]))["text"], "hi")
+            self.assertEqual((await other.receive(sockets[1]))["text"], "hi")
+
+            # A process whose socket left hears no more of it
+            await other.group_discard("palace_hybrid", sockets[1])
+            await moderator.group_send("palace_hybrid", {"type": "frame", "text": "again"})
+            self.assertEqual((await web.receive(sockets[0]))["text"], "again")
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(other.receive(sockets[1]), 0.1)
+        finally:
+            await self.close()
+
+    async def test_moderator_messages_reach_players(self):
+        web = self.layer(InstrumentedChannelLayer(self.config))
+        self.addCleanup(messages.take)
+        moderator = GameConsumer()
+        moderator.channel_layer = self.layer()
+        moderator.resumed = True
+
+        try:
+            socket = await web.new_channel()
+            await web.group_add("palace_hybrid", socket)
+            await web.send(
+                "moderator.0",
+                {"type": "connect", "id": "hybrid", "username": "ann", "player_channel": socket},
+            )
+            await moderator.dispatch(await moderator.channel_layer.receive("moderator.0"))
+
+            # The roster goes to the group and the full list to the player alone
+            received = [json.loads((await web.receive(socket))["text"]) for _ in range(2)]
+            self.assertEqual([frame["op"] for frame in received], ["join", "full"])
+            self.assertEqual(web.totals["delivered"], 2)
+        finally:
+            await self.close()
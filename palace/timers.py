@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# One pending deadline. cancel() takes it straight out of its
+# bucket, so cancelling is as cheap as scheduling.
+class Timer:
+    __slots__ = ("wheel", "deadline", "callback", "args", "bucket", "level")
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+        self.level = 0
+
+    @property
+    def pending(self):
+        return self.bucket is not None
+
+    # Seconds until this fires
+    def remaining(self):
+        return max(0.0, (self.deadline - self.wheel.current_tick()) * self.wheel.tick)
+
+    # The wall clock time this fires at, the same every time it's asked
+    def due(self):
+        return self.wheel.started + self.deadline * self.wheel.tick
+
+    def cancel(self):
+        if self.bucket is not None:
+            del self.bucket[self]
+            self.bucket = None
+            self.wheel.count -= 1
+
+            if self.level == 0:
+                self.wheel.low -= 1
+
+
+# A hierarchical timing wheel, like the one in the Linux kernel.
+# Level 0 has one bucket per tick, every level above it covers
+# 64 times the span of the one below. A deadline lands in the lowest
+# level that reaches it and is moved down a level ("cascaded") as its
+# time gets near, so inserting and cancelling never search or sort.
+# The clock can be swapped out, which lets tests fast-forward time.
+class TimingWheel:
+    # Small levels keep each cascade short, so firing stays on time
+    # even when a lot of deadlines come down at once
+    BITS = 6
+    SLOTS = 1 << BITS
+    MASK = SLOTS - 1
+
+    def __init__(self, tick=0.005, levels=6, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.start = clock()
+        # Where the wall clock was at tick 0
+        self.started = time.time()
+        self.now = 0
+        self.count = 0
+        self.low = 0
+        self.levels = [[{} for _ in range(self.SLOTS)] for _ in range(levels)]
+        self.span = self.SLOTS**levels
+
+    def __len__(self):
+        return self.count
+
+    # Fire callback(*args) once delay seconds have passed
+    def schedule(self, delay, callback, *args):
+        current = self.current_tick()
+
+        # An empty wheel is not ticked, so it may have fallen behind
+        if not self.count:
+            self.now = max(self.now, current)
+
+        ticks = max(1, math.ceil(delay / self.tick)) + max(0, current - self.now)
+        timer = Timer(self, self.now + min(ticks, self.span - 1), callback, args)
+        self.place(timer)
+        self.count += 1
+        return timer
+
+    def place(self, timer):
+        remaining = timer.deadline - self.now
+        level = (remaining.bit_length() - 1) // self.BITS if remaining else 0
+
+        timer.level = level
+        timer.bucket = self.levels[level][
+            (timer.deadline >> (self.BITS * level)) & self.MASK
+        ]
+        timer.bucket[timer] = None
+
+        if level == 0:
+            self.low += 1
+
+    def current_tick(self):
+        return int((self.clock() - self.start) / self.tick)
+
+    # Seconds until something could be due. With nothing in level 0
+    # that is the next time it wraps and a cascade brings timers down.
+    def until_next_tick(self):
+        due = self.now + 1 if self.low else (self.now | self.MASK) + 1
+        return max(0.0, self.start + due * self.tick - self.clock())
+
+    # Catch the wheel up with the clock, firing everything that is due
+    def advance(self):
+        target = self.current_tick()
+
+        while self.now < target:
+            if not self.count:
+                self.now = target
+                break
+
+            # Nothing can fire before level 0 wraps around again
+            if not self.low:
+                self.now = min(target, self.now | self.MASK)
+
+                if self.now == target:
+                    break
+
+            self.now += 1
+            self.cascade()
+
+            index = self.now & self.MASK
+            bucket = self.levels[0][index]
+
+            if bucket:
+                self.levels[0][index] = {}
+
+                for timer in bucket:
+                    timer.bucket = None
+                    self.count -= 1
+                    self.low -= 1
+                    timer.callback(*timer.args)
+
+    # Each time a level wraps around, the matching bucket one level
+    # up is emptied and its deadlines are placed again, closer in
+    def cascade(self):
+        for level in range(1, len(self.levels)):
+            shift = self.BITS * level
+
+            if (self.now >> (shift - self.BITS)) & self.MASK:
+                break
+
+            index = (self.now >> shift) & self.MASK
+            bucket = self.levels[level][index]
+
+            if bucket:
+                self.levels[level][index] = {}
+
+                for timer in bucket:
+                    self.place(timer)
+
+
+# Runs a game phase after a delay on the moderator's own event loop.
+# Nothing sleeps and no threads are started, so a countdown in one
+# lobby never holds up events from the others. Deadlines are kept
+# in a timing wheel, ticked by one timer on the loop that is armed
+# for the wheel's next tick while anything is pending. A deadline
+# nearer than that moves the loop's timer up, it isn't left waiting
+# behind one far off.
+class Scheduler:
+    def __init__(self, wheel=None):
+        self.wheel = wheel if wheel is not None else TimingWheel()
+        self.tasks = set()
+        self.wakeup = None
+
+    # Returns a Timer whose cancel() stops the phase from running
+    def call_later(self, delay, callback, *args):
+        timer = self.wheel.schedule(delay, self.run, callback, args)
+        self.arm()
+        return timer
+
+    def arm(self):
+        loop = asyncio.get_running_loop()
+        when = loop.time() + self.wheel.until_next_tick()
+
+        if self.wakeup is not None:
+            if self.wakeup.when() <= when:
+                return None
+
+            self.wakeup.cancel()
+
+        self.wakeup = loop.call_at(when, self.tick)
+
+    def tick(self):
+        self.wakeup = None
+        self.wheel.advance()
+
+        if len(self.wheel):
+            self.arm()
+
+    def run(self, callback, args):
+        task = asyncio.ensure_future(callback(*args))
+
+        # Keep a reference until it finishes, the loop only holds weak ones
+        self.tasks.add(task)
+        task.add_done_callback(self.done)
+
+    def done(self, task):
+        self.tasks.discard(task)
+
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Game phase failed", exc_info=task.exception())
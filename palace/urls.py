@@ -5,7 +5,8 @@ app_name = "palace"
 urlpatterns = [
     path('', views.IndexView.as_view(), name='index'),
     path('games', views.GameIndexView.as_view(), name='games'),
-    path('players/<str:player>/', views.PlayerView.as_view(), name='player'),
+    path('leaderboard', views.LeaderboardView.as_view(), name='leaderboard'),
+    path('players/<str:player>/', views.PlayerProfileView, name='player'),
     path('profile/', views.SelfPlayerView, name='profile'),
     path("lobby/<str:lobby_name>/", views.LobbyView, name="lobby"),
     path("lobby0/", views.LobbyZed, name="lobby0"),
@@ -5,26 +5,106 @@ from django.shortcuts import redirect
 from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect
+from django.db import transaction
+from django.db.models import F
+from django.utils.functional import cached_property
+from django.views.decorators.http import condition
+from django.middleware.csrf import get_token
+from hashlib import md5
 
-from .models import Player, Game
+from .leaderboard import leaderboard
+from .models import Player, Game, lobbies_changed, lobby_generation
 
 
 class IndexView(generic.TemplateView):
     template_name = "palace/index.html"
 
+# One page of the lobby list, starting after a cursor taken from the
+# last lobby of the page before. Nothing is queried until the template
+# asks for it, so a page served from the cache costs no queries, and
+# a page that isn't never skips over rows to find where it starts.
+class LobbyPage:
+    size = 20
+
+    def __init__(self, queryset, cursor):
+        self.queryset = queryset
+        self.cursor = cursor
+
+    # The rest of the cursor's occupancy, then the emptier lobbies.
+    # Each is a seek into the list's index, however deep the page.
+    @cached_property
+    def lobbies(self):
+        wanted = self.size + 1
+
+        if self.cursor is None:
+            return list(self.queryset[:wanted])
+
+        occupancy, lobby_name = self.cursor
+        lobbies = list(
+            self.queryset.filter(occupancy=occupancy, lobby_name__gt=lobby_name)[:wanted]
+        )
+
+        if len(lobbies) < wanted:
+            lobbies += self.queryset.filter(occupancy__lt=occupancy)[: wanted - len(lobbies)]
+
+        return lobbies
+
+    def items(self):
+        return self.lobbies[: self.size]
+
+    def next(self):
+        if len(self.lobbies) > self.size:
+            last = self.lobbies[self.size - 1]
+            return "%d.%s" % (last.occupancy, last.lobby_name)
+
+
+# Cursors look like "<occupancy>.<lobby_name>", anything else is
+# treated as the first page
+def parse_cursor(value):
+    occupancy, dot, lobby_name = value.partition(".")
+
+    if not (occupancy.isdigit() and dot and lobby_name):
+        return None
+
+    return int(occupancy), lobby_name
+
+
 class GameIndexView(generic.TemplateView):
     template_name = "palace/game_index.html"
 
     def get_context_data(self, **kwargs):
         context = super(GameIndexView, self).get_context_data(**kwargs)
-        context['lobbies'] = Game.objects.all()
+        show = self.request.GET.get("show")
+        cursor = parse_cursor(self.request.GET.get("after", ""))
+
+        if show == "playing":
+            lobbies = Game.objects.playing()
+        else:
+            show = "open"
+            lobbies = Game.objects.open()
+
+        context['show'] = show
+        context['after'] = "%d.%s" % cursor if cursor else ""
+        context['page'] = LobbyPage(lobbies, cursor)
+        context['generation'] = lobby_generation()
         return context
 
 
-@login_required
-def SelfPlayerView(request):
-    username = request.user.username
-    return redirect("../players/" + username)
+class LeaderboardView(generic.TemplateView):
+    template_name = "palace/leaderboard.html"
+
+    def get_context_data(self, **kwargs):
+        context = super(LeaderboardView, self).get_context_data(**kwargs)
+        leaderboard.warm()
+        context['leaders'] = [
+            {"rank": leaderboard.rank(name), "player": name, "wins": wins}
+            for name, wins in leaderboard.top(20)
+        ]
+
+        if self.request.user.is_authenticated:
+            context['rank'] = leaderboard.rank(self.request.user.username)
+
+        return context
 
 
 class PlayerView(generic.DetailView):
@@ -34,20 +114,99 @@ class PlayerView(generic.DetailView):
     model = Player
     template_name = "palace/profile.html"
 
+
+# A profile only changes when a game its player was in ends, which
+# bumps the player's version and updated time. Browsers asking again
+# get a 304 off that one small lookup, without the page being rendered.
+# The navbar (and its csrf token) differ per visitor, so the ETag
+# covers who is looking as well as whose profile it is.
+def profile_stamp(request, player):
+    stamps = request.__dict__.setdefault("profile_stamps", {})
+
+    if player not in stamps:
+        stamps[player] = (
+            Player.objects.filter(player=player).values_list("version", "updated").first()
+        )
+
+    return stamps[player]
+
+
+def profile_etag(request, player):
+    stamp = profile_stamp(request, player)
+
+    if stamp is None:
+        return None
+
+    if not request.user.is_authenticated:
+        return "%s-anon" % stamp[0]
+
+    # Makes sure the visitor has a csrf secret before the page uses it
+    get_token(request)
+    viewer = "%s:%s" % (request.user.pk, request.META["CSRF_COOKIE"])
+    return "%s-%s" % (stamp[0], md5(viewer.encode()).hexdigest()[:12])
+
+
+def profile_last_modified(request, player):
+    stamp = profile_stamp(request, player)
+    return stamp and stamp[1]
+
+
+@condition(etag_func=profile_etag, last_modified_func=profile_last_modified)
+def PlayerProfileView(request, player):
+    return PlayerView.as_view()(request, player=player)
+
+
+# Rendered here rather than redirected to their page, saving a round trip
+@login_required
+def SelfPlayerView(request):
+    return PlayerProfileView(request, player=request.user.username)
+
+# Claim a seat in a lobby for a player who isn't in one. The lobby's
+# counter and the player's row only change together, and only while
+# the lobby has room and the player is still free, so joins racing
+# for the last seat can't overfill it.
+def take_seat(player, lobby):
+    with transaction.atomic():
+        seated = Game.objects.filter(
+            pk=lobby.pk, occupancy__lt=F("capacity")
+        ).update(occupancy=F("occupancy") + 1)
+
+        if not seated:
+            return False
+
+        # Joined somewhere else meanwhile, the seat goes back
+        if not Player.objects.filter(pk=player.pk, ingame=None).update(ingame=lobby):
+            transaction.set_rollback(True)
+            return False
+
+    player.ingame_id = lobby.pk
+    lobbies_changed()
+    return True
+
+
 @login_required
 def LobbyView(request, lobby_name):
+    player = request.user.player
+
     # User enters a lobby. If not in the database already, it is created
     lobby, created = Game.objects.get_or_create(lobby_name=lobby_name)
 
-    # But maybe the user is already in a game... lets check
+    if created:
+        lobbies_changed()
+
+    # But maybe the user is already in a game... lets check.
+    # A player already seated here takes their seat again without
+    # anything being written
     # [Checking which specific user made this HTTP request
     # is possible because of the @login_required decorator above]
-    if request.user.player.ingame != None and request.user.player.ingame != lobby:
-        return HttpResponse("<h1>You're in a game already</h1>")
+    if player.ingame_id is None and not take_seat(player, lobby):
+        player.refresh_from_db(fields=["ingame"])
+
+        if player.ingame_id is None:
+            return HttpResponse("<h1>This lobby is full</h1>")
 
-    elif request.user.player.ingame == None:
-        request.user.player.ingame = lobby
-        request.user.player.save()
+    if player.ingame_id != lobby.pk:
+        return HttpResponse("<h1>You're in a game already</h1>")
 
     # Dynamically render an HTML page for them
     return render(
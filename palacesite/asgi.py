@@ -10,9 +10,9 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 import os
 
 from django.urls import re_path
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, ChannelNameRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "palacesite.settings")
@@ -21,17 +21,28 @@ django_asgi_app = get_asgi_application()
 
 import palace.routing
 from palace import consumers
+from palace.auth import PlayerAuthMiddlewareStack
+from palace.leaderboard import FollowWins
+from palace.node import InProcessModerators
+from palace.sharding import moderator_channels
 
 application = ProtocolTypeRouter(
     {
         "http": django_asgi_app,
         "websocket": AllowedHostsOriginValidator(
-            AuthMiddlewareStack(URLRouter(palace.routing.websocket_urlpatterns))
+            PlayerAuthMiddlewareStack(URLRouter(palace.routing.websocket_urlpatterns))
         ),
         "channel": ChannelNameRouter(
             {
-                "moderator": consumers.GameConsumer.as_asgi(),
+                channel: consumers.GameConsumer.as_asgi()
+                for channel in moderator_channels()
             }
         ),
     }
 )
+
+# Wins the moderators write reach this process's leaderboard as they happen
+application = FollowWins(application)
+
+if settings.PALACE_SINGLE_NODE:
+    application = InProcessModerators(application)
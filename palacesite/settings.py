@@ -79,12 +79,53 @@ WSGI_APPLICATION = 'palacesite.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# PALACE_DATABASE picks a profile:
+#   sqlite (default) - one file, in WAL mode so readers never wait on
+#       the writer, with a busy timeout so writers queue up instead of
+#       failing, and connections kept open between requests.
+#   postgres - for more than one server process. Connections come from
+#       a pool (Django 5.1+, psycopg[pool]) as big as the thread pool
+#       sync_to_async runs database calls on, every thread can hold one.
+
+PALACE_DATABASE = os.environ.get("PALACE_DATABASE", "sqlite")
+
+# The size of asgiref's thread pool, which reads the same variable
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", min(32, (os.cpu_count() or 1) + 4)))
+
+if PALACE_DATABASE == "postgres":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get("POSTGRES_DB", "palace"),
+            'USER': os.environ.get("POSTGRES_USER", "palace"),
+            'PASSWORD': os.environ.get("POSTGRES_PASSWORD", ""),
+            'HOST': os.environ.get("POSTGRES_HOST", "127.0.0.1"),
+            'PORT': os.environ.get("POSTGRES_PORT", "5432"),
+            'OPTIONS': {
+                'pool': {
+                    'min_size': 2,
+                    'max_size': ASGI_THREADS,
+                    'timeout': 10,
+                },
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # Seconds a writer waits for the lock before giving up
+                'timeout': 20,
+            },
+            'CONN_MAX_AGE': 600,
+            'CONN_HEALTH_CHECKS': True,
+        }
     }
-}
+
+# Run on every new SQLite connection, see palace/signals.py
+SQLITE_PRAGMAS = ["journal_mode=WAL", "synchronous=NORMAL"]
 
 
 # Password validation
@@ -131,11 +172,102 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGIN_REDIRECT_URL = '/'
 
 ASGI_APPLICATION = "palacesite.asgi.application"
+# Every socket of a server process shares one Redis list, its messages
+# are taken off straight away and wait in palace.layers instead
+REDIS_LAYER = {
+    "BACKEND": "channels_redis.core.RedisChannelLayer",
+    "CONFIG": {
+        "hosts": [("127.0.0.1", 6379)],
+        "capacity": 1000,
+    },
+}
+
+# Everything in one process: the moderators run inside the ASGI server
+# (see asgi.py) and reach the consumers through an in-memory layer,
+# with no Redis round trip for every chat line. Set PALACE_SINGLE_NODE=1
+# to use it, with a single server process only.
+# The moderators' channels take every lobby's demands, so they get
+# more room than a socket's.
+IN_PROCESS_LAYER = {
+    "BACKEND": "palace.node.InProcessChannelLayer",
+    "CONFIG": {
+        "capacity": 1000,
+        "channel_capacity": {"moderator.*": 10000},
+        "expiry": 60,
+    },
+}
+
+PALACE_SINGLE_NODE = os.environ.get("PALACE_SINGLE_NODE") == "1"
+
+# Lobby broadcasts over Redis pub/sub, one publish per broadcast instead
+# of a write for every player, while the moderators' channels stay on
+# Redis lists. Set PALACE_REDIS_PUBSUB=1 to use it.
+REDIS_PUBSUB_LAYER = {
+    "BACKEND": "palace.layers.HybridChannelLayer",
+    "CONFIG": {
+        "broadcast": {
+            "BACKEND": "channels_redis.pubsub.RedisPubSubChannelLayer",
+            "CONFIG": {
+                "hosts": REDIS_LAYER["CONFIG"]["hosts"],
+            },
+        },
+        "queued": REDIS_LAYER,
+        "queued_channels": ["moderator.*"],
+    },
+}
+
+PALACE_REDIS_PUBSUB = os.environ.get("PALACE_REDIS_PUBSUB") == "1"
+
+if PALACE_SINGLE_NODE:
+    PALACE_LAYER = IN_PROCESS_LAYER
+elif PALACE_REDIS_PUBSUB:
+    PALACE_LAYER = REDIS_PUBSUB_LAYER
+else:
+    PALACE_LAYER = REDIS_LAYER
+
+# Whichever layer is picked is wrapped to count what's sent, dropped
+# and expired. A socket that falls behind gets its messages buffered
+# per class, chat can go well before game events do. Once more than
+# slow_depth wait, PALACE_SLOW_SOCKETS decides what happens to it:
+#   drop_chat (default) - chat is dropped, game events still queue up
+#   coalesce - waiting frames go out together as one batch
+#   disconnect - the socket is closed, its page reloads and starts over
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "palace.layers.InstrumentedChannelLayer",
         "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+            "layer": PALACE_LAYER,
+            "policy": os.environ.get("PALACE_SLOW_SOCKETS", "drop_chat"),
+            "slow_depth": 50,
+            "classes": {
+                "chat": {"capacity": 100, "expiry": 10},
+                "game": {"capacity": 1000, "expiry": 120},
+            },
         },
     },
-}
\ No newline at end of file
+}
+
+# Lobbies are spread over this many moderator workers,
+# run them with "runmoderator"
+MODERATOR_SHARDS = int(os.environ.get("MODERATOR_SHARDS", 1))
+
+# Where moderators keep snapshots of running games so a restarted
+# worker can resume them, set to None to turn it off
+MODERATOR_SNAPSHOTS = os.environ.get(
+    "MODERATOR_SNAPSHOTS", BASE_DIR / "moderator.sqlite3"
+)
+
+# Signed-in WebSocket users are cached by session key for this many
+# seconds, up to this many per process. Name a cache from CACHES in
+# PLAYER_AUTH_SHARED_CACHE to share them between processes as well.
+PLAYER_AUTH_CACHE_SIZE = int(os.environ.get("PLAYER_AUTH_CACHE_SIZE", 10000))
+PLAYER_AUTH_CACHE_TTL = int(os.environ.get("PLAYER_AUTH_CACHE_TTL", 60))
+PLAYER_AUTH_SHARED_CACHE = os.environ.get("PLAYER_AUTH_SHARED_CACHE")
+
+# How fast a socket may send chat lines and commands, as (per second,
+# burst) token buckets for each socket and for each user across their
+# sockets. Anything over is turned away with an error frame.
+PLAYER_RATE_LIMITS = {
+    "chat": {"connection": (1, 5), "user": (2, 8)},
+    "command": {"connection": (4, 10), "user": (6, 15)},
+}